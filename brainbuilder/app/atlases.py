@@ -4,18 +4,31 @@
 import itertools
 import logging
 import os
+import zlib
 from collections import OrderedDict
 from pathlib import Path
 
 import click
+import nrrd
 import numpy as np
 from voxcell import VoxelData, math_utils
 
+from brainbuilder.exceptions import BrainBuilderError
 from brainbuilder.masks import regular_convex_polygon_mask_from_side
 from brainbuilder.utils import dump_json
 
 L = logging.getLogger("brainbuilder")
 
+# Region identifier of the root of the mosaic hierarchy
+MOSAIC_ROOT_ID = 65535
+
+# Compression level of the NRRD files, the default of `nrrd.write` used by `VoxelData.save_nrrd`
+NRRD_COMPRESSION_LEVEL = 9
+
+# Axial coordinates of the columns of the O1 mosaic in label order, kept to preserve
+# the region identifiers of the atlases built when only the O0 and O1 mosaics were supported
+O1_COLUMNS = [(0, -1), (-1, 0), (0, 0), (1, -1), (-1, 1), (0, 1), (1, 0)]
+
 
 def _align_thickness(thickness, voxel_side):
     """Align layer boundaries along voxel grid."""
@@ -34,35 +47,72 @@ def _compact(mask):
     return math_utils.clip(mask, aabb)
 
 
+def _hex_round(q, r):
+    """Round fractional axial coordinates to the axial coordinates of the nearest hexagon."""
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype(np.int64), rr.astype(np.int64)
+
+
+def _mosaic_columns(width):
+    """Axial coordinates (q, r) of the columns of O<width> mosaic, in label order.
+
+    The columns are the hexagons at a distance of at most `width` from the central one,
+    sorted along the first axis, then along the second one.
+    """
+    if width == 1:
+        return O1_COLUMNS
+    columns = [
+        (q, r)
+        for q in range(-width, width + 1)
+        for r in range(max(-width, -q - width), min(width, -q + width) + 1)
+    ]
+    return sorted(columns, key=lambda qr: (qr[0], 2 * qr[1] + qr[0]))
+
+
 def _build_2D_mosaic(width, hex_side, voxel_side):
-    """Build 2D matrix representing O<K> mosaic."""
-    hexagon = _compact(regular_convex_polygon_mask_from_side(hex_side, 6, voxel_side))
-    w, h = hexagon.shape
+    """Build 2D matrix representing O<K> mosaic.
+
+    Each voxel is labeled at once with the column it belongs to (or -1), from the axial
+    coordinates of the hexagon containing its center; see
+    https://www.redblobgames.com/grids/hexagons/ for the hexagonal grid conventions.
+    The hexagons have a vertex along the first axis, and the central one is centered at the origin.
+    The single column (O0) mosaic keeps the rasterized hexagon, so that its atlases are unchanged.
+    """
+    # pylint: disable=too-many-locals
+    if width == 0:
+        hexagon = _compact(regular_convex_polygon_mask_from_side(hex_side, 6, voxel_side))
+        offset = -0.5 * np.array(hexagon.shape) * voxel_side
+        return np.where(hexagon, 0, -1).astype(np.int16), offset
+
+    radius = hex_side / voxel_side
+    half_shape = np.ceil([radius * (1.5 * width + 1), radius * np.sqrt(3) * (width + 0.5)]).astype(
+        int
+    )
 
-    hex_center = {
-        0: [
-            [0, 0],
-        ],
-        1: [
-            [1, 1],
-            [0, 2],
-            [1, 3],
-            [2, 2],
-            [0, 4],
-            [1, 5],
-            [2, 4],
-        ],
-    }[width]
+    # voxel centers, relative to the origin and in units of hexagon radius
+    x = (np.arange(-half_shape[0], half_shape[0]) + 0.5)[:, np.newaxis] / radius
+    z = (np.arange(-half_shape[1], half_shape[1]) + 0.5)[np.newaxis, :] / radius
+    q, r = _hex_round(2.0 / 3.0 * x, -1.0 / 3.0 * x + np.sqrt(3) / 3.0 * z)
 
-    shift = np.array(hex_center) * (3 * w // 4, h // 2)
+    # lookup table from the shifted axial coordinates to the column labels
+    labels = np.full((2 * width + 1, 2 * width + 1), -1, dtype=np.int16)
+    for column_label, (column_q, column_r) in enumerate(_mosaic_columns(width)):
+        labels[column_q + width, column_r + width] = column_label
 
-    shape = np.max(shift, axis=0) + (w, h)
-    mosaic = np.full(shape, -1, dtype=np.int16)
-    for column_label, (dx, dz) in enumerate(shift):
-        mosaic[dx : dx + w, dz : dz + h][hexagon] = column_label
+    mosaic = np.full(q.shape, -1, dtype=np.int16)
+    inside = (np.abs(q) + np.abs(r) + np.abs(q + r)) <= 2 * width
+    mosaic[inside] = labels[q[inside] + width, r[inside] + width]
 
-    offset = -0.5 * np.array([w, h]) * voxel_side
-    return mosaic, offset
+    # trim the empty borders
+    aabb = math_utils.minimum_aabb(mosaic >= 0)
+    offset = (aabb[0] - half_shape) * voxel_side
+    return math_utils.clip(mosaic, aabb), offset
 
 
 def _build_column_brain_regions(width, hex_side, layers, voxel_side):
@@ -74,13 +124,17 @@ def _build_column_brain_regions(width, hex_side, layers, voxel_side):
     columns = np.unique(mosaic_2D[mosaic_2D >= 0])
 
     region_ids = OrderedDict(((column_label, None), k) for k, column_label in enumerate(columns, 1))
+    if len(columns) * (len(layers) + 1) >= MOSAIC_ROOT_ID:
+        raise BrainBuilderError(f"Too many regions for O{width} mosaic with {len(layers)} layers")
+
+    # position of each label in `columns`, or -1 outside of the mosaic
+    column_index = np.where(mosaic_2D >= 0, np.searchsorted(columns, mosaic_2D), -1)
 
     for name, thickness in layers.items():
-        pattern = np.zeros_like(mosaic_2D, dtype=np.uint16)
-        for column_label in columns:
-            region_id = max(region_ids.values()) + 1
-            region_ids[(column_label, name)] = region_id
-            pattern[mosaic_2D == column_label] = region_id
+        first_region_id = max(region_ids.values()) + 1
+        for k, column_label in enumerate(columns):
+            region_ids[(column_label, name)] = first_region_id + k
+        pattern = np.where(column_index >= 0, first_region_id + column_index, 0).astype(np.uint16)
         mosaic_3d_layers.append(np.repeat([pattern], thickness // voxel_side, axis=0))
 
     mosaic_3D = np.swapaxes(np.vstack(mosaic_3d_layers), 0, 1)
@@ -127,42 +181,28 @@ def _build_hyperrectangle_brain_regions(x, z, layers, voxel_side):
     return brain_regions, region_id
 
 
-def _initialize_raw(brain_regions, dtype, value, add_dim=0):
-    """Initialize a np array that will contain atlas data."""
-    if add_dim > 0:
-        shape = brain_regions.shape + (add_dim,)
-    else:
-        shape = brain_regions.shape
-    layer_array = np.full(shape, value, dtype=dtype)
-    return layer_array
-
-
 def _build_orientation(brain_regions):
     """Build 'orientation' VoxelData."""
-    raw = _initialize_raw(brain_regions, np.int8, 0, add_dim=4)
-    raw[:, :, :, 0] = 127
+    raw = np.broadcast_to(np.array([127, 0, 0, 0], dtype=np.int8), brain_regions.shape + (4,))
     return brain_regions.with_data(raw)
 
 
 def _build_layer_profile(brain_regions, boundaries):
     """Build '[PH]<layer>' VoxelData."""
-    raw = _initialize_raw(brain_regions, np.float32, np.nan, add_dim=2)
-    for j in range(brain_regions.raw.shape[1]):
-        raw[:, j, :] = list(boundaries)
+    raw = np.broadcast_to(np.array(boundaries, dtype=np.float32), brain_regions.shape + (2,))
     return brain_regions.with_data(raw)
 
 
 def _build_y(brain_regions):
     """Build '[PH]y' VoxelData."""
-    raw = _initialize_raw(brain_regions, np.float32, np.nan)
     voxel_side = brain_regions.voxel_dimensions[1]
-    for j in range(brain_regions.raw.shape[1]):
-        raw[:, j, :] = brain_regions.offset[1] + voxel_side * (0.5 + j)
+    y = brain_regions.offset[1] + voxel_side * (0.5 + np.arange(brain_regions.shape[1]))
+    raw = np.broadcast_to(y.astype(np.float32)[:, np.newaxis], brain_regions.shape)
     return brain_regions.with_data(raw)
 
 
-def _add_layers_atlases(datasets, layers, brain_regions):
-    """Update the layer dataset with layer profiles"""
+def _iter_layers_atlases(layers, brain_regions):
+    """Yield the name and the VoxelData of the layer profiles"""
 
     def _pairwise(iterable):
         """s -> (s0,s1), (s1,s2), (s2, s3), ..."""
@@ -173,20 +213,69 @@ def _add_layers_atlases(datasets, layers, brain_regions):
     thickness_cumsum = [0.0] + list(np.cumsum(list(layers.values())))
     boundaries = np.array(list(_pairwise(thickness_cumsum)))
     for (name, _), bounds in zip(layers.items(), boundaries):
-        datasets.update({"[PH]" + name: _build_layer_profile(brain_regions, bounds)})
+        yield "[PH]" + name, _build_layer_profile(brain_regions, bounds)
 
 
-def _dump_atlases(brain_regions, layers, output_dir):
-    """Dump mandatory circuit building atlases."""
-    datasets = {
-        "brain_regions": brain_regions,
-        "orientation": _build_orientation(brain_regions),
-        "[PH]y": _build_y(brain_regions),
+def _nrrd_header(voxel_data):
+    """Return the NRRD header fields of `voxel_data`, as written by `VoxelData.save_nrrd`."""
+    space_directions = list(np.diag(voxel_data.voxel_dimensions))
+    dim_defect = voxel_data.raw.ndim - voxel_data.ndim
+    header = {
+        "space dimension": voxel_data.ndim,
+        "space directions": [[np.nan] * voxel_data.ndim] * dim_defect + space_directions,
+        "space origin": voxel_data.offset,
     }
-    _add_layers_atlases(datasets, layers, brain_regions)
-    for name, data in datasets.items():
+    if dim_defect == 1 and np.issubdtype(voxel_data.raw.dtype, np.number):
+        header["kinds"] = ["vector", "domain", "domain", "domain"]
+    return header
+
+
+def _save_nrrd_by_slabs(voxel_data, nrrd_path):
+    """Save `voxel_data` to a gzip encoded nrrd file, one slab along the last axis at a time.
+
+    Only one slab of `voxel_data.raw` is materialized at once, so that datasets built by
+    broadcasting can be written without allocating memory proportional to the volume.
+    In NRRD, the first axis is the fastest varying, so the slabs are contiguous in Fortran
+    ordered arrays. The header is written by pynrrd, and is the same as the one written by
+    `VoxelData.save_nrrd`.
+    """
+    assert voxel_data.ndim == 3, "Only 3D volumes are supported"
+    assert voxel_data.raw.ndim <= 4, "Only scalar and vector fields are supported"
+
+    # in NRRD, the payload axis goes first, as in `VoxelData.save_nrrd`
+    data = voxel_data.raw
+    if data.ndim > voxel_data.ndim:
+        data = np.moveaxis(data, -1, 0)
+    # pylint: disable=protected-access
+    header = nrrd.writer._handle_header(data, _nrrd_header(voxel_data))
+
+    compressor = zlib.compressobj(NRRD_COMPRESSION_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    with open(nrrd_path, "wb") as f:
+        nrrd.writer._write_header(f, header)
+        for k in range(data.shape[-1]):
+            f.write(compressor.compress(data[..., k].tobytes(order="F")))
+        f.write(compressor.flush())
+
+
+def _dump_atlases(brain_regions, layers, output_dir):
+    """Dump mandatory circuit building atlases.
+
+    The datasets are built lazily and written one at a time, so that the memory needed does
+    not depend on the number of layers.
+    """
+    # the slabs written by `_save_nrrd_by_slabs` are contiguous in Fortran ordered arrays
+    brain_regions = brain_regions.with_data(np.asfortranarray(brain_regions.raw))
+    datasets = itertools.chain(
+        [
+            ("brain_regions", brain_regions),
+            ("orientation", _build_orientation(brain_regions)),
+            ("[PH]y", _build_y(brain_regions)),
+        ],
+        _iter_layers_atlases(layers, brain_regions),
+    )
+    for name, data in datasets:
         L.info("Write '%s.nrrd'...", name)
-        data.save_nrrd(os.path.join(output_dir, name + ".nrrd"))
+        _save_nrrd_by_slabs(data, os.path.join(output_dir, name + ".nrrd"))
 
 
 def _column_hierarchy(column_label, layers, region_ids):
@@ -218,7 +307,7 @@ def _mosaic_hierarchy(width, layers, region_ids):
     columns = sorted(set(col for col, _ in region_ids))
     return OrderedDict(
         [
-            ("id", 65535),
+            ("id", MOSAIC_ROOT_ID),
             ("acronym", f"O{width}"),
             ("name", f"O{width} mosaic"),
             ("children", [_column_hierarchy(c, layers, region_ids) for c in columns]),
@@ -301,7 +390,14 @@ def app(ctx, layer_names, thickness, voxel_side, output_dir):
 
 
 @app.command()
-@click.option("-w", "--width", type=int, help="Mosaic width (0 for single column)", default=0)
+@click.option(
+    "-w",
+    "--width",
+    type=int,
+    help="Mosaic width, i.e. number of rings of columns around the central one "
+    "(0 for single column)",
+    default=0,
+)
 @click.option("-a", "--hex-side", type=float, help="Hexagon side (um)", required=True)
 @click.pass_context
 def column(ctx, width, hex_side):
@@ -311,7 +407,7 @@ def column(ctx, width, hex_side):
     output_dir = ctx.obj["output_dir"]
     layers = ctx.obj["layers"]
 
-    assert width in (0, 1)
+    assert width >= 0
 
     brain_regions, region_ids = _build_column_brain_regions(width, hex_side, layers, voxel_side)
 
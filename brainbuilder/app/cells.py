@@ -41,8 +41,10 @@ Based on:
 import logging
 import numbers
 from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
 import click
+import h5py
 import numpy as np
 import pandas as pd
 from voxcell import (
@@ -57,11 +59,20 @@ from voxcell.nexus.voxelbrain import Atlas
 from brainbuilder import BrainBuilderError
 from brainbuilder.app._utils import REQUIRED_PATH
 from brainbuilder.cell_positions import create_cell_positions
-from brainbuilder.utils import bbp, deprecate, load_yaml
+from brainbuilder.utils import (
+    append_to_dataset,
+    bbp,
+    create_appendable_dataset,
+    deprecate,
+    load_yaml,
+)
 from brainbuilder.utils.bbp import load_cell_composition
 
 L = logging.getLogger("brainbuilder")
 
+# Name of the node population written by `positions_and_orientations`
+ATLAS_CELLS_POPULATION = "atlas_cells"
+
 
 @click.group()
 def app():
@@ -85,6 +96,64 @@ def load_mini_frequencies(filepath):
     return pd.read_csv(filepath, sep=r"\s+", index_col="layer", dtype={"layer": str})
 
 
+def _iter_prefetched(func, values):
+    """Yield `func(value)` for each of `values`, computing the next result in a background thread.
+
+    Used to overlap the reading and decoding of the next NRRD file (gzip decompression and disk
+    reads release the GIL) with the processing of the current one; `func` must be thread-safe.
+    Only one result is computed ahead, so that at most two of them are in memory at the same
+    time, provided that the caller releases each result before getting the next one.
+    """
+    values = list(values)
+    if not values:
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(func, values[0])
+        for next_value in values[1:]:
+            result = future.result()
+            future = executor.submit(func, next_value)
+            yield result
+            del result
+        yield future.result()
+
+
+def _read_density(value, atlas):
+    """Read density values from NRRD file or atlas dataset.
+
+    Args:
+        value: see `_load_density`
+        atlas: Atlas to use for loading atlas datasets
+
+    Returns:
+        3D float64 numpy array if `value` refers to a NRRD file or an atlas dataset,
+        `value` unchanged otherwise.
+    """
+    if isinstance(value, numbers.Number):
+        result = value
+    elif value.startswith("{"):
+        assert value.endswith("}")
+        dataset = value[1:-1]
+        L.info("Loading 3D density profile from '%s' atlas dataset...", dataset)
+        result = atlas.load_data(dataset, cls=VoxelData).raw.astype(np.float64)
+    elif value.endswith(".nrrd"):
+        L.info("Loading 3D density profile from '%s'...", value)
+        result = VoxelData.load_nrrd(value).raw.astype(np.float64)
+    else:
+        raise BrainBuilderError(f"Unexpected density value: '{value}'")
+    return result
+
+
+def _prefetch_density(value):
+    """Read the density values of the NRRD file `value`, return other values unchanged.
+
+    The atlas datasets are not read, since the atlas and its cache may not be thread-safe;
+    they are read by `_load_density` in the calling thread.
+    """
+    if isinstance(value, str) and value.endswith(".nrrd"):
+        return _read_density(value, atlas=None)
+    return value
+
+
 def _load_density(value, mask, atlas):
     """Load density as 3D numpy array.
 
@@ -93,6 +162,7 @@ def _load_density(value, mask, atlas):
             - float value (constant density per `mask`)
             - path to NRRD file (load from file, filter by `mask`)
             - dataset in `atlas` (load from atlas, filter by `mask`)
+            - 3D numpy array already read with `_read_density` (filter by `mask`)
         mask: 0/1 3D mask
         atlas: Atlas to use for loading atlas datasets
 
@@ -101,19 +171,14 @@ def _load_density(value, mask, atlas):
     Returns:
         3D float32 numpy array of same shape as `mask`.
     """
+    if not isinstance(value, np.ndarray):
+        value = _read_density(value, atlas)
+
     if isinstance(value, numbers.Number):
         result = np.zeros_like(mask, dtype=np.float64)
         result[mask] = float(value)
-    elif value.startswith("{"):
-        assert value.endswith("}")
-        dataset = value[1:-1]
-        L.info("Loading 3D density profile from '%s' atlas dataset...", dataset)
-        result = atlas.load_data(dataset, cls=VoxelData).raw.astype(np.float64)
-    elif value.endswith(".nrrd"):
-        L.info("Loading 3D density profile from '%s'...", value)
-        result = VoxelData.load_nrrd(value).raw.astype(np.float64)
     else:
-        raise BrainBuilderError(f"Unexpected density value: '{value}'")
+        result = value
 
     # Mask away density values outside region mask (NaNs are fine there)
     result[~mask] = 0
@@ -134,14 +199,21 @@ def _load_density(value, mask, atlas):
     return result
 
 
-def _create_cell_group(conf, atlas, root_mask, density_factor, soma_placement):
+def _create_cell_group(conf, atlas, root_mask, density_factor, soma_placement, density=None):
+    """Create the cells of the group `conf` of the cell composition recipe.
+
+    `density` is the density of the group as returned by `_prefetch_density`, see
+    `_load_density`; it is loaded from `conf['density']` if None.
+    """
     region_mask = atlas.get_region_mask(conf["region"], with_descendants=True, memcache=True)
     if root_mask is not None:
         region_mask.raw &= root_mask.raw
     if not np.any(region_mask.raw):
         raise BrainBuilderError(f"Empty region mask for region: '{conf['region']}'")
 
-    density = region_mask.with_data(_load_density(conf["density"], region_mask.raw, atlas))
+    if density is None:
+        density = conf["density"]
+    density = region_mask.with_data(_load_density(density, region_mask.raw, atlas))
 
     pos = create_cell_positions(density, density_factor=density_factor, method=soma_placement)
     result = pd.DataFrame(pos, columns=["x", "y", "z"])
@@ -256,10 +328,14 @@ def _place(
             root_mask.raw &= region_mask.raw
 
     L.info("Creating cell groups...")
-    groups = [
-        _create_cell_group(conf, atlas, root_mask, density_factor, soma_placement)
-        for conf in recipe["neurons"]
-    ]
+    densities = _iter_prefetched(_prefetch_density, [conf["density"] for conf in recipe["neurons"]])
+    groups = []
+    for conf, density in zip(recipe["neurons"], densities):
+        groups.append(
+            _create_cell_group(conf, atlas, root_mask, density_factor, soma_placement, density)
+        )
+        # release the density before the next one is read
+        del density
 
     L.info("Merging into single CellCollection...")
     result = pd.concat(groups)
@@ -454,6 +530,60 @@ def assign_emodels(cells_path, morphdb, seed, output):
     result.save(output)
 
 
+def _init_atlas_cells_group(population, region_id_dtype):
+    """Create the empty appendable datasets of the group '0' of the atlas cells `population`.
+
+    The 'cell_type' dataset is filled with the index of each cell type in the
+    '@library/cell_type' enumeration, written by `_finalize_atlas_cells_population`.
+    """
+    group = population.create_group("0")
+    for name in ["x", "y", "z", "orientation_w", "orientation_x", "orientation_y", "orientation_z"]:
+        create_appendable_dataset(group, name, np.float32)
+    create_appendable_dataset(group, "region_id", region_id_dtype)
+    create_appendable_dataset(group, "cell_type", np.uint32)
+    return group
+
+
+def _append_atlas_cells(group, positions, orientations, region_ids, cell_type_index):
+    """Append the cells of a single cell type to the atlas cells `group`.
+
+    Args:
+        group: h5py group created by `_init_atlas_cells_group`
+        positions: (N, 3) array of cell positions
+        orientations: (N, 4) array of quaternions of the form [w, x, y, z]
+        region_ids: (N,) array of region identifiers
+        cell_type_index: index of the cell type in the '@library/cell_type' enumeration
+    """
+    for axis, name in enumerate("xyz"):
+        append_to_dataset(group[name], positions[:, axis].astype(np.float32))
+    for axis, name in enumerate("wxyz"):
+        append_to_dataset(group[f"orientation_{name}"], orientations[:, axis].astype(np.float32))
+    append_to_dataset(group["region_id"], region_ids.astype(group["region_id"].dtype))
+    append_to_dataset(group["cell_type"], np.full(len(positions), cell_type_index, np.uint32))
+
+
+def _finalize_atlas_cells_population(population, cell_types):
+    """Add the datasets of the atlas cells `population` that need the cell count.
+
+    `cell_types` are the cell types indexed by the 'cell_type' dataset. As done by
+    `voxcell.CellCollection.save_sonata` for categorical properties, they are written to
+    '@library/cell_type', unless there are at least half as many cell types as cells, in which
+    case the 'cell_type' dataset is replaced by the cell type names.
+    """
+    group = population["0"]
+    count = len(group["x"])
+    population.create_dataset("node_type_id", shape=(count,), dtype=np.int64, fillvalue=-1)
+    str_dtype = h5py.special_dtype(vlen=str)
+    if len(cell_types) < 0.5 * count:
+        group.create_dataset(
+            "@library/cell_type", data=np.asarray(cell_types, dtype=object), dtype=str_dtype
+        )
+    else:
+        names = np.asarray(cell_types, dtype=object)[group["cell_type"][()]]
+        del group["cell_type"]
+        group.create_dataset("cell_type", data=names, dtype=str_dtype)
+
+
 @app.command(
     short_help="Generate cell positions and save them together with orientations,"
     " region annotations and cell types"
@@ -583,7 +713,10 @@ def positions_and_orientations(annotation_path, orientation_path, config_path, o
         /nodes/atlas_cells/0/z   Dataset\n
         /nodes/atlas_cells/node_type_id Dataset\n
 
-        Note: The node_type_ids are all set to -1 by voxcell.CellCollection.save_sonata)\n
+        Note: The node_type_ids are all set to -1, as done by voxcell.CellCollection.save_sonata\n
+
+    The cells are written to the output file one cell type at a time, so that the whole
+    collection of cells is never held in memory.\n
 
     How to read the output file:\n
         # The recommanded way: use voxcell.CellCollection support for libsonata\n
@@ -622,82 +755,67 @@ def positions_and_orientations(annotation_path, orientation_path, config_path, o
         annotation.voxel_dimensions, orientation.voxel_dimensions
     ), "The annotation and orientation files have different voxel dimensions."
 
-    # The columns to be populated
-    positions = []
-    orientations = []
-    region_ids = []
-    cell_types = []
-
-    for cell_type, density_path in config["inputDensityVolumePath"].items():
-        L.info("Loading density file %s ...", density_path)
-        density_voxel_data = VoxelData.load_nrrd(density_path)
-        if not np.allclose(density_voxel_data.offset, annotation.offset):
-            raise BrainBuilderError(
-                f"The input density file {density_path} and the input annotation file "
-                f"{annotation_path} have different offsets: "
-                f"{density_voxel_data.offset} != {annotation.offset}"
-            )
-        if not np.allclose(density_voxel_data.voxel_dimensions, annotation.voxel_dimensions):
-            raise BrainBuilderError(
-                f"The input density file {density_path} and the input annotation file "
-                f"{annotation_path} have different voxel dimensions: "
-                f"{density_voxel_data.voxel_dimensions} != {annotation.voxel_dimensions}"
+    cell_types = list(config["inputDensityVolumePath"])
+    # the cell types with at least one cell, in the order of the cells
+    placed_cell_types = []
+
+    L.info("Writing %s in sonata format ...", output_path)
+    with h5py.File(output_path, "w") as h5f:
+        population = h5f.create_group(f"/nodes/{ATLAS_CELLS_POPULATION}")
+        group = _init_atlas_cells_group(population, annotation.raw.dtype)
+
+        density_paths = [config["inputDensityVolumePath"][cell_type] for cell_type in cell_types]
+        densities = _iter_prefetched(VoxelData.load_nrrd, density_paths)
+
+        for cell_type, density_path, density_voxel_data in zip(
+            cell_types, density_paths, densities
+        ):
+            L.info("Loaded density file %s ...", density_path)
+            if not np.allclose(density_voxel_data.offset, annotation.offset):
+                raise BrainBuilderError(
+                    f"The input density file {density_path} and the input annotation file "
+                    f"{annotation_path} have different offsets: "
+                    f"{density_voxel_data.offset} != {annotation.offset}"
+                )
+            if not np.allclose(density_voxel_data.voxel_dimensions, annotation.voxel_dimensions):
+                raise BrainBuilderError(
+                    f"The input density file {density_path} and the input annotation file "
+                    f"{annotation_path} have different voxel dimensions: "
+                    f"{density_voxel_data.voxel_dimensions} != {annotation.voxel_dimensions}"
+                )
+
+            # Microglia cell density can take negative values, see
+            # https://bbpteam.epfl.ch/project/issues/browse/NSETM-1260.
+            # As a temporary fix, negative values are zeroed. Hence -S extra cells
+            # are created where S is the sum of negative values.
+            # TODO: implement a long term solution in atlas-building-tools
+            negative_mask = density_voxel_data.raw < 0.0
+            if np.any(negative_mask):
+                L.warning(
+                    "Negative density values in %s summing up to %f. Zeroing negative values.",
+                    density_path,
+                    np.sum(density_voxel_data.raw[negative_mask]),
+                )
+                density_voxel_data.raw[negative_mask] = 0.0
+
+            L.info('Creating cell positions for the cell type "%s" ...', cell_type)
+            positions = create_cell_positions(density_voxel_data, seed=0)
+            del density_voxel_data
+            if len(positions) == 0:
+                continue
+
+            L.info('Retrieving voxel indices for the cell type "%s\n" ...', cell_type)
+            voxel_indices = tuple(annotation.positions_to_indices(positions).T)
+
+            L.info('Writing the cells of type "%s" ...', cell_type)
+            _append_atlas_cells(
+                group,
+                positions,
+                # We assume quaternions to be under the form [w, x, y, z]
+                orientation.raw[voxel_indices],
+                annotation.raw[voxel_indices],
+                len(placed_cell_types),
             )
+            placed_cell_types.append(cell_type)
 
-        # Microglia cell density can take negative values, see
-        # https://bbpteam.epfl.ch/project/issues/browse/NSETM-1260.
-        # As a temporary fix, negative values are zeroed. Hence -S extra cells
-        # are created where S is the sum of negative values.
-        # TODO: implement a long term solution in atlas-building-tools
-        negative_mask = density_voxel_data.raw < 0.0
-        if np.any(negative_mask):
-            L.warning(
-                "Negative density values in %s summing up to %f. Zeroing negative values.",
-                density_path,
-                np.sum(density_voxel_data.raw[negative_mask]),
-            )
-            density_voxel_data.raw[negative_mask] = 0.0
-
-        L.info('Creating cell positions for the cell type "%s" ...', cell_type)
-        positions_ = create_cell_positions(density_voxel_data, seed=0)
-        positions.append(positions_)
-
-        L.info('Retrieving voxel indices for the cell type "%s\n" ...', cell_type)
-        voxel_indices = annotation.positions_to_indices(positions_)
-        voxel_indices = tuple(voxel_indices.T)
-        orientations.append(orientation.raw[voxel_indices])
-        region_ids.append(annotation.raw[voxel_indices])
-        cell_types += [cell_type] * len(voxel_indices[0])
-
-    L.info(
-        "Creation of the cell collection dataframe."
-        " \n Setting positions, orientations, region ids and cell types ..."
-    )
-    datasets = np.hstack(
-        [
-            np.asarray(np.concatenate(positions), dtype=np.float32),
-            np.asarray(np.concatenate(orientations), dtype=np.float32),
-        ]
-    )
-    df = pd.DataFrame(
-        datasets,
-        columns=[
-            "x",
-            "y",
-            "z",
-            # We assume quaternions to be under the form [w, x, y, z]
-            "orientation_w",
-            "orientation_x",
-            "orientation_y",
-            "orientation_z",
-        ],
-    )
-    df["region_id"] = np.concatenate(region_ids)
-    df["cell_type"] = cell_types
-    df.index = 1 + np.arange(len(df))  # CellCollection has a 1-based index
-    L.info("Building a voxcell.CellCollection ...")
-    cells = CellCollection.from_dataframe(df)
-    cells.population_name = "atlas_cells"
-
-    L.info("Saving %s to sonata format ...", output_path)
-    cells.save_sonata(output_path)
+        _finalize_atlas_cells_population(population, placed_cell_types)
@@ -1,13 +1,13 @@
 # SPDX-License-Identifier: Apache-2.0
 """ Tools for working with MVD3 """
 
+import os
 import shutil
 from builtins import input  # pylint: disable=redefined-builtin
 
 import click
-import numpy as np
-import pandas as pd
-from voxcell import CellCollection, VoxelData
+import h5py
+from voxcell import VoxelData
 
 from brainbuilder.utils import bbp
 
@@ -23,6 +23,10 @@ def app():
 @click.option("-o", "--output", help="Path to output MVD3", required=True)
 def reorder_mtypes(mvd3, recipe, output):
     """Align /library/mtypes with builder recipe"""
+    if os.path.realpath(output) == os.path.realpath(mvd3):
+        # the MVD3 is edited in place, no need to copy it
+        bbp.reorder_mtypes(mvd3, recipe)
+        return
     tmp_path = output + "~"
     shutil.copy(mvd3, tmp_path)
     bbp.reorder_mtypes(tmp_path, recipe)
@@ -34,18 +38,31 @@ def reorder_mtypes(mvd3, recipe, output):
 @click.option("-p", "--prop", help="Property name to use", required=True)
 @click.option("-d", "--voxel-data", help="Path NRRD with to volumetric data", required=True)
 @click.option("-o", "--output", help="Path to output MVD3", required=True)
-def add_property(mvd3, prop, voxel_data, output):
-    """Add property to MVD3 based on volumetric data"""
-    cells = CellCollection.load_mvd3(mvd3)
-    if prop in cells.properties:
-        choice = input(
-            f"There is already '{prop}' property in the provided MVD3. Overwrite (y/n)? "
-        )
-        if choice.lower() not in ("y", "yes"):
+@click.option(
+    "--overwrite/--no-overwrite",
+    default=None,
+    help="Overwrite (or keep) an already existing property without asking for confirmation",
+)
+def add_property(mvd3, prop, voxel_data, output, overwrite):
+    """Add property to MVD3 based on volumetric data
+
+    Only the new property is written: the MVD3 is edited in place if the output path is the
+    input path, and copied to the output path first otherwise.
+    """
+    with h5py.File(mvd3, "r") as h5f:
+        exists = f"/cells/properties/{prop}" in h5f
+    if exists:
+        if overwrite is None:
+            choice = input(
+                f"There is already '{prop}' property in the provided MVD3. Overwrite (y/n)? "
+            )
+            overwrite = choice.lower() in ("y", "yes")
+        if not overwrite:
             return
     voxel_data = VoxelData.load_nrrd(voxel_data)
-    cells.properties[prop] = voxel_data.lookup(cells.positions)
-    cells.save_mvd3(output)
+    if os.path.realpath(output) != os.path.realpath(mvd3):
+        shutil.copy(mvd3, output)
+    bbp.add_mvd3_property(output, prop, voxel_data)
 
 
 @app.command()
@@ -53,7 +70,4 @@ def add_property(mvd3, prop, voxel_data, output):
 @click.option("-o", "--output", help="Path to output MVD3", required=True)
 def merge(mvd3, output):
     """Merge multiple MVD3 files"""
-    chunks = [CellCollection.load_mvd3(filepath).as_dataframe() for filepath in mvd3]
-    merged = pd.concat(chunks, ignore_index=True)
-    merged.index = 1 + np.arange(len(merged))
-    CellCollection.from_dataframe(merged).save_mvd3(output)
+    bbp.merge_mvd3(mvd3, output)
@@ -329,8 +329,15 @@ def simple_split_subcircuit(nodeset, nodeset_path, nodes, edges, output):
     help="Extract external connections; ones that are non-virtual, but sourced from"
     "outside the extracted subcircuit - they become virtual nodes",
 )
+@click.option(
+    "--max-workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Maximum number of processes writing the edge files, the memory used grows with it "
+    "[default: number of CPUs, at most 4]",
+)
 @click.option("-o", "--output", required=True, type=REQUIRED_PATH_DIR, help="Output directory")
-def split_subcircuit(nodeset, circuit, include_virtual, create_external, output):
+def split_subcircuit(nodeset, circuit, include_virtual, create_external, max_workers, output):
     """Split a subcircuit out from a SONATA circuit based on node_set"""
     from brainbuilder.utils.sonata import split_population as module
 
@@ -340,6 +347,7 @@ def split_subcircuit(nodeset, circuit, include_virtual, create_external, output)
         circuit_config_path=circuit,
         do_virtual=include_virtual,
         create_external=create_external,
+        max_workers=max_workers,
     )
 
     click.echo(
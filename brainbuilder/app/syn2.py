@@ -57,12 +57,27 @@ def _get_property_dtypes(path):
 
 def _concat_h5(output, sources):
     """create `output` from `sources`, uses first source as source of truth for properties"""
+    properties = _get_property_dtypes(sources[0])
+
+    # the sizes of the sources are counted first, so that the output is allocated once
+    expected_sizes = dict.fromkeys(properties, 0)
+    for source in sources:
+        with h5py.File(source, "r") as h5:
+            prop = h5[PROPERTIES_PATH]
+            for name in properties:
+                expected_sizes[name] += len(prop[name])
+
     with h5py.File(output, "w") as h5o:
         output_properties = h5o.create_group(PROPERTIES_PATH)
 
-        properties = _get_property_dtypes(sources[0])
+        writers = {}
         for name, dtype in properties.items():
-            utils.create_appendable_dataset(output_properties, name, dtype)
+            utils.create_appendable_dataset(
+                output_properties, name, dtype, expected_size=expected_sizes[name]
+            )
+            writers[name] = utils.AppendableDatasetWriter(
+                output_properties[name], expected_size=expected_sizes[name]
+            )
 
         for source in sources:
             L.debug("Opening source: %s", source)
@@ -70,7 +85,10 @@ def _concat_h5(output, sources):
                 prop = h5[PROPERTIES_PATH]
                 for name in properties:
                     L.debug("Copying property[%s] %s", source, name)
-                    utils.append_to_dataset(output_properties[name], prop[name])
+                    writers[name].append(prop[name][()])
+
+        for writer in writers.values():
+            writer.close()
 
 
 def _check_syn2_invariants(path, population, expected_properties, afferent_index=True):
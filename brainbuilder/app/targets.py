@@ -10,7 +10,7 @@ import voxcell
 import brainbuilder
 import brainbuilder.targets
 from brainbuilder.exceptions import BrainBuilderError
-from brainbuilder.utils import bbp, dump_json
+from brainbuilder.utils import bbp, dump_node_sets
 
 L = logging.getLogger("brainbuilder")
 
@@ -80,8 +80,8 @@ def from_input(cells_path, atlas, atlas_cache, targets, allow_empty, output):
             if atlas_based is not None:
                 atlas = brainbuilder.targets.load_atlas(atlas, atlas_cache)
                 xyz = cells[["x", "y", "z"]].to_numpy()
-                for name, dset in atlas_based.items():
-                    mask = atlas.load_data(dset, cls=voxcell.ROIMask).lookup(xyz)
+                masks = brainbuilder.targets.lookup_atlas_masks(atlas, atlas_based, xyz)
+                for name, mask in masks.items():
                     bbp.write_target(f, name, cells.index[mask])
 
 
@@ -120,4 +120,4 @@ def node_sets(
         cells, full_hierarchy, atlas, targets, allow_empty, population
     )
 
-    dump_json(output, result)
+    dump_node_sets(output, result)
@@ -1,10 +1,16 @@
 # SPDX-License-Identifier: Apache-2.0
-""" Helper methods for cell orientations. """
+"""Helper methods for cell orientations."""
 
 import numpy as np
+from scipy.spatial.transform import Rotation
 from voxcell.math_utils import angles_to_matrices
 
-from brainbuilder.utils.random import parse_distr
+from brainbuilder.utils.random import sample_distr
+
+# Number of cells whose rotations are composed at once by `apply_random_rotations`
+CHUNK_SIZE = 1_000_000
+
+AXES = ("x", "y", "z")
 
 
 def apply_rotation(A, angles, axis):
@@ -37,5 +43,91 @@ def apply_random_rotation(A, axis, distr):
     Returns:
         (N, 3, 3) array of mutated rotation matrices
     """
-    angles = parse_distr(distr).rvs(size=A.shape[0])
-    return apply_rotation(A, angles, axis)
+    return apply_random_rotations(A, [(axis, distr)])
+
+
+def _rotate_quaternions(q, angles, axis):
+    """Right-multiply in place the [w, x, y, z] quaternions `q` by rotations around `axis`."""
+    i = AXES.index(axis)
+    j, k = (i + 1) % 3 + 1, (i + 2) % 3 + 1
+    i += 1
+    c, s = np.cos(0.5 * angles), np.sin(0.5 * angles)
+    w, vi, vj, vk = q[:, 0].copy(), q[:, i].copy(), q[:, j].copy(), q[:, k].copy()
+    q[:, 0] = c * w - s * vi
+    q[:, i] = c * vi + s * w
+    q[:, j] = c * vj + s * vk
+    q[:, k] = c * vk - s * vj
+
+
+def _multiply_quaternions(p, q):
+    """Return the products of the [w, x, y, z] quaternions `p` and `q`."""
+    pw, pv = p[:, :1], p[:, 1:]
+    qw, qv = q[:, :1], q[:, 1:]
+    w = pw * qw - np.sum(pv * qv, axis=1, keepdims=True)
+    v = pw * qv + qw * pv + np.cross(pv, qv)
+    return np.hstack([w, v])
+
+
+def _quaternions_to_matrices(q):
+    """Convert [w, x, y, z] quaternions to rotation matrices."""
+    return Rotation.from_quat(q[:, [1, 2, 3, 0]]).as_matrix()
+
+
+def _matrices_to_quaternions(A):
+    """Convert rotation matrices to [w, x, y, z] quaternions."""
+    return Rotation.from_matrix(A).as_quat()[:, [3, 0, 1, 2]]
+
+
+def _compose_orientations(A, q, output):
+    """Right-multiply the orientations `A` by the [w, x, y, z] quaternions `q`.
+
+    `A` and the result are in the formats described in `apply_random_rotations`.
+    """
+    is_quaternion = A.shape[1:] == (4,)
+    if output == "matrices":
+        if is_quaternion:
+            return _quaternions_to_matrices(_multiply_quaternions(A, q))
+        return np.einsum("...ij,...jk->...ik", A, _quaternions_to_matrices(q))
+    orientations = A if is_quaternion else _matrices_to_quaternions(A)
+    return _multiply_quaternions(orientations, q)
+
+
+def apply_random_rotations(A, rotations, output="matrices", chunk_size=CHUNK_SIZE, rng=None):
+    """
+    Apply a sequence of random rotations around given axes.
+
+    All the angles are sampled up front, in the same order as successive calls to
+    `apply_random_rotation` would do. The rotations are then composed as quaternions,
+    in place and by chunks of `chunk_size` cells, and applied to `A` once.
+
+    Args:
+        A: (N, 3, 3) array of rotation matrices or (N, 4) array of [w, x, y, z] quaternions
+        rotations: sequence of (axis, distr) pairs, see `apply_random_rotation`
+        output: 'matrices' for a (N, 3, 3) array of rotation matrices, or 'quaternions'
+            for a (N, 4) array of [w, x, y, z] quaternions, as stored in SONATA
+        chunk_size: number of cells processed at once
+        rng: `numpy.random.Generator` used to sample the angles, see `sample_distr`
+
+    Returns:
+        array of mutated orientations in the `output` format
+    """
+    if output not in ("matrices", "quaternions"):
+        raise ValueError(f"Unknown output format: {output}")
+    A = np.asarray(A)
+    count = A.shape[0]
+    axes = [axis for axis, _ in rotations]
+    for axis in axes:
+        if axis not in AXES:
+            raise ValueError(f"Unknown axis: {axis}")
+    angles = [sample_distr(distr, count, rng) for _, distr in rotations]
+
+    result = np.empty((count, 3, 3) if output == "matrices" else (count, 4))
+    for start in range(0, count, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        q = np.zeros((len(A[chunk]), 4))
+        q[:, 0] = 1.0
+        for axis, values in zip(axes, angles):
+            _rotate_quaternions(q, values[chunk], axis)
+        result[chunk] = _compose_orientations(A[chunk], q, output)
+
+    return result
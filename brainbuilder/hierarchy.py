@@ -0,0 +1,80 @@
+# SPDX-License-Identifier: Apache-2.0
+"""Array based index of a region hierarchy, for bulk ancestor and descendant queries."""
+
+import numpy as np
+
+
+class HierarchyIndex:
+    """Region hierarchy stored as arrays, regions being referred to by their position.
+
+    Attributes:
+        ids: (N,) array of region identifiers
+        acronyms: (N,) array of region acronyms
+        parents: (N,) array of the positions of the parents, -1 for the roots
+        depths: (N,) array of the depths, 0 for the roots
+        starts, stops: (N,) arrays, the positions of the descendants (self included) of the
+            region at position `i` are `order[starts[i]:stops[i]]`
+        order: (N,) array of the positions of the regions in depth-first order
+    """
+
+    def __init__(self, region_map_df):
+        """Constructor
+
+        Args:
+            region_map_df: DataFrame indexed by region id, with 'acronym' and 'parent_id'
+                columns (-1 for the roots), as returned by `voxcell.RegionMap.as_dataframe`
+        """
+        self.ids = region_map_df.index.to_numpy()
+        self.acronyms = region_map_df["acronym"].to_numpy()
+        self.parents = region_map_df.index.get_indexer(region_map_df["parent_id"])
+        # the last region wins for duplicated acronyms
+        self._acronym_positions = {acronym: i for i, acronym in enumerate(self.acronyms)}
+
+        children = [[] for _ in self.ids]
+        for child, parent in enumerate(self.parents):
+            if parent != -1:
+                children[parent].append(child)
+
+        count = len(self.ids)
+        self.order = np.empty(count, dtype=np.int64)
+        self.starts = np.empty(count, dtype=np.int64)
+        self.stops = np.empty(count, dtype=np.int64)
+        self.depths = np.empty(count, dtype=np.int64)
+        tour = 0
+        # (position, depth, is_exit) stack of the Euler tour
+        stack = [(root, 0, False) for root in reversed(np.flatnonzero(self.parents == -1))]
+        while stack:
+            position, depth, is_exit = stack.pop()
+            if is_exit:
+                self.stops[position] = tour
+                continue
+            self.order[tour] = position
+            self.starts[position] = tour
+            self.depths[position] = depth
+            tour += 1
+            stack.append((position, depth, True))
+            stack.extend((child, depth + 1, False) for child in reversed(children[position]))
+        if tour != count:
+            raise ValueError("The region hierarchy contains cycles")
+
+    @classmethod
+    def from_region_map(cls, region_map):
+        """Build the index of a `voxcell.RegionMap`."""
+        return cls(region_map.as_dataframe())
+
+    def positions(self, acronyms):
+        """Return the positions of the regions with the given `acronyms`."""
+        return np.array([self._acronym_positions[a] for a in acronyms], dtype=np.int64)
+
+    def descendants(self, positions):
+        """Return the sorted positions of the descendants of `positions`, themselves included."""
+        tour = np.zeros(len(self.ids) + 1, dtype=np.int64)
+        np.add.at(tour, self.starts[positions], 1)
+        np.add.at(tour, self.stops[positions], -1)
+        return np.sort(self.order[np.cumsum(tour[:-1]) > 0])
+
+    def ancestors(self, positions):
+        """Return the sorted positions of the ancestors of `positions`, themselves included."""
+        starts = np.sort(self.starts[positions])
+        counts = np.searchsorted(starts, self.stops) - np.searchsorted(starts, self.starts)
+        return np.flatnonzero(counts > 0)
@@ -4,32 +4,49 @@
 import numpy as np
 
 
-def _is_in_triangle(p, v0, v1, v2, epsilon=0.00001):
-    """return True if the point p is inside the triangle defined by the vertices v0, v1, v2"""
+def _signed_area(vertices):
+    """return the signed area of the 2D polygon defined by `vertices` (> 0 if counterclockwise)"""
+    x, y = vertices.T
+    return 0.5 * np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)
 
-    def vector_to(p0, p1):
-        """return a normalized vector p0->p1. Return None if p0 IS p1"""
-        to_p1 = p1 - p0
-        d2 = np.sum(np.square(to_p1), axis=0)
-        if d2 < epsilon:
-            return None
-        else:
-            return to_p1 / np.sqrt(d2)
 
-    to_v0 = vector_to(p, v0)
-    to_v1 = vector_to(p, v1)
-    to_v2 = vector_to(p, v2)
+def convex_polygon_mask(shape, vertices, epsilon=0.00001):
+    """build the boolean mask of a 2D convex polygon
 
-    if to_v0 is None or to_v1 is None or to_v2 is None:
-        return True
+    A point of the index grid belongs to the polygon if it lies on the inner side of all
+    the edges (or on the edges themselves, up to `epsilon`): the half-plane tests are evaluated
+    over the whole index grid at once, one edge at a time.
 
-    angle = (
-        np.arccos(np.dot(to_v0, to_v1))
-        + np.arccos(np.dot(to_v1, to_v2))
-        + np.arccos(np.dot(to_v2, to_v0))
-    )
+    Args:
+        shape(tuple): sequence of two ints. Shape of the new mask.
+        vertices(numpy.ndarray): (N, 2) array of the vertices of the convex polygon, in either
+            clockwise or counterclockwise order
+        epsilon(float): tolerance (in voxels) for the points lying on the edges
 
-    return np.fabs(angle - (2 * np.pi)) < epsilon
+    Returns:
+        A numpy boolean array of the given shape
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    if _signed_area(vertices) < 0:
+        vertices = vertices[::-1]
+
+    i, j = np.ogrid[: shape[0], : shape[1]]
+
+    # restricting to the bounding box handles degenerate polygons (i.e. with collinear vertices)
+    (i_min, j_min), (i_max, j_max) = vertices.min(axis=0), vertices.max(axis=0)
+    mask = (i >= i_min - epsilon) & (i <= i_max + epsilon) & (j >= j_min - epsilon)
+    mask &= j <= j_max + epsilon
+
+    for v0, v1 in zip(vertices, np.roll(vertices, -1, axis=0)):
+        edge = v1 - v0
+        length = np.linalg.norm(edge)
+        if length < epsilon:
+            continue
+        # cross product of the edge with the vector v0->p, i.e. the signed distance
+        # of the points p from the edge line, multiplied by the length of the edge
+        mask &= edge[0] * (j - v0[1]) - edge[1] * (i - v0[0]) >= -epsilon * length
+
+    return mask
 
 
 def triangular_mask(shape, v0, v1, v2):
@@ -44,18 +61,7 @@ def triangular_mask(shape, v0, v1, v2):
     Returns:
         A numpy boolean array of the given shape
     """
-    mask = np.ones(shape, dtype=bool)
-    idx = np.nonzero(mask)
-    aidx = np.array(idx).transpose()
-    r = np.zeros(aidx.shape[0], dtype=bool)  # pylint: disable=unsubscriptable-object
-
-    # TODO make is_in_triangle take arrays of points so we don't need to do one by one
-    for i, p in enumerate(aidx):
-        r[i] = _is_in_triangle(p, v0, v1, v2)
-
-    mask[idx] = r
-
-    return mask
+    return convex_polygon_mask(shape, [v0, v1, v2])
 
 
 def regular_convex_polygon_mask(shape, radius, vertex_count):
@@ -69,20 +75,13 @@ def regular_convex_polygon_mask(shape, radius, vertex_count):
     """
     assert vertex_count > 2
 
-    angles = np.arange(vertex_count + 1) * ((2 * np.pi) / vertex_count)
+    angles = np.arange(vertex_count) * ((2 * np.pi) / vertex_count)
     points = radius * np.array([np.cos(angles), np.sin(angles)]).transpose()
 
     center = (np.array(shape) - 1) * 0.5
     points += center
 
-    mask = np.zeros(shape, dtype=bool)
-    point_idx = np.arange(vertex_count + 1)
-
-    for i0, i1 in zip(point_idx[:-1], point_idx[1:]):
-        m = triangular_mask(shape, points[i0], center, points[i1])
-        mask |= m
-
-    return mask
+    return convex_polygon_mask(shape, points)
 
 
 def regular_convex_polygon_mask_from_side(side_size, vertex_count, voxel_size):
@@ -1,14 +1,23 @@
 """Handling of targets and nodesets"""
 
 import collections
+import inspect
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 import bluepysnap
+import numpy as np
+import pandas as pd
 import voxcell
 from voxcell.nexus.voxelbrain import Atlas
 
 from brainbuilder.exceptions import BrainBuilderError
+from brainbuilder.hierarchy import HierarchyIndex
 from brainbuilder.utils import load_yaml
 
+# Maximum number of atlas mask datasets loaded concurrently
+MASK_LOADING_WORKERS = 4
+
 
 def load_atlas(atlas_path, atlas_cache_path):
     """Try and load the atlas."""
@@ -18,6 +27,46 @@ def load_atlas(atlas_path, atlas_cache_path):
     return atlas
 
 
+def lookup_atlas_masks(atlas, atlas_based, positions):
+    """Return which `positions` are in the mask of each atlas based target.
+
+    The mask datasets are loaded in parallel, at most `MASK_LOADING_WORKERS` ahead of the lookup,
+    and each mask is released after its lookup. The voxel indices of `positions` are computed
+    once for all the masks sharing the same voxel grid.
+
+    Args:
+        atlas(voxcell.nexus.voxelbrain.Atlas): atlas
+        atlas_based(dict): target name -> mask dataset name
+        positions(np.array): (N, 3) array of positions
+
+    Returns:
+        dict: target name -> (N,) boolean array
+    """
+    indices = {}
+    result = {}
+    datasets = iter(atlas_based.items())
+    with ThreadPoolExecutor(max_workers=MASK_LOADING_WORKERS) as executor:
+
+        def _submit(count):
+            for name, dset in itertools.islice(datasets, count):
+                futures.append((name, executor.submit(atlas.load_data, dset, cls=voxcell.ROIMask)))
+
+        futures = collections.deque()
+        _submit(MASK_LOADING_WORKERS)
+        while futures:
+            name, future = futures.popleft()
+            mask = future.result()
+            del future
+            # load the next mask only when one is consumed, to bound the masks in memory
+            _submit(1)
+            grid = (mask.shape, tuple(mask.offset), tuple(mask.voxel_dimensions))
+            if grid not in indices:
+                indices[grid] = tuple(mask.positions_to_indices(positions).T)
+            result[name] = mask.raw[indices[grid]]
+            del mask
+    return result
+
+
 def _enforce_layer_to_str(data):
     for key, value in data.items():
         if isinstance(value, dict):
@@ -50,26 +99,28 @@ def load_targets(filepath):
     )
 
 
-def _add_occupied_hierarchy(region_map_df, occupied_regions, result):
+def _add_occupied_hierarchy(hierarchy, occupied_regions, result):
     """Create node_sets for `occupied_regions`
 
     For regions that have children AND contents, we have a '$region-only' nodeset
 
     Note that result is passed with already populated regions such that
     an '$result-only' can be created when there are conflicts
-    """
-    occupied_regions = set(occupied_regions)
 
-    region2parent_id = region_map_df.set_index("acronym")["parent_id"].to_dict()
-    id2region = region_map_df["acronym"].to_dict()
+    Args:
+        hierarchy(brainbuilder.hierarchy.HierarchyIndex): region hierarchy
+        occupied_regions: acronyms of the regions containing cells
+        result(dict): node sets to update
+    """
+    occupied = hierarchy.positions(set(occupied_regions))
+    # the regions on the paths from the occupied regions to the root, in depth-first order
+    regions = hierarchy.ancestors(occupied)
+    regions = regions[np.argsort(hierarchy.starts[regions])]
+    regions = regions[hierarchy.parents[regions] != -1]
 
     to_add = collections.defaultdict(set)
-    for region in occupied_regions:
-        parent_region_id = region2parent_id[region]
-        while parent_region_id != -1:
-            parent_region = id2region[parent_region_id]
-            to_add[parent_region].add(region)
-            region, parent_region_id = parent_region, region2parent_id[parent_region]
+    for region, parent in zip(hierarchy.acronyms[regions], hierarchy.parents[regions]):
+        to_add[hierarchy.acronyms[parent]].add(region)
 
     for region, subregions in to_add.items():
         if region in result:
@@ -78,6 +129,46 @@ def _add_occupied_hierarchy(region_map_df, occupied_regions, result):
         result[region] = sorted(subregions)
 
 
+def _equality_props(cells, query):
+    """Return the properties of `query` if it only tests cells properties for equality.
+
+    Such queries are of the form {prop: value, ...}, where `prop` is a non floating point
+    column of `cells` and `value` a scalar; None is returned for any other query.
+    """
+    if not isinstance(query, dict) or not query:
+        return None
+    for prop, value in query.items():
+        if (
+            prop not in cells.columns
+            or np.issubdtype(cells[prop].dtype.type, np.floating)
+            or not isinstance(value, (str, int, np.integer))
+        ):
+            return None
+    return tuple(sorted(query))
+
+
+def _occupied_values(cells, props):
+    """Return the set of tuples of values of `props` taken by at least one cell.
+
+    The properties are factorized, and the distinct combinations of codes are found at once.
+    """
+    codes, uniques = zip(*(pd.factorize(cells[prop]) for prop in props))
+    codes = np.column_stack(codes)
+    codes = codes[np.all(codes >= 0, axis=1)]  # missing values
+    return {tuple(values[i] for values, i in zip(uniques, row)) for row in np.unique(codes, axis=0)}
+
+
+def _resolve_ids(cells, population, query):
+    """Return the mask of `cells` matched by `query`, with bluepysnap 1.x or later.
+
+    The recent versions of `bluepysnap.query.resolve_ids` also take the type of the population.
+    """
+    if "population_type" in inspect.signature(bluepysnap.query.resolve_ids).parameters:
+        return bluepysnap.query.resolve_ids(cells, population, "biophysical", query)
+    # pylint: disable=no-value-for-parameter
+    return bluepysnap.query.resolve_ids(cells, population, query)
+
+
 def create_node_sets(cells, full_hierarchy, atlas, targets, allow_empty, population):
     """Create and return a node sets dictionary
 
@@ -94,14 +185,22 @@ def create_node_sets(cells, full_hierarchy, atlas, targets, allow_empty, populat
     result = {}
 
     cells = cells.as_dataframe()
+    occupied_values = {}
+
+    def _is_empty(query):
+        props = _equality_props(cells, query)
+        if props is None:
+            return not _resolve_ids(cells, population, query).any()
+        if props not in occupied_values:
+            occupied_values[props] = _occupied_values(cells, props)
+        return tuple(query[prop] for prop in props) not in occupied_values[props]
 
     def _add_node_sets(to_add):
         for name, query in sorted(to_add.items()):
             if name in result:
                 raise BrainBuilderError(f"Duplicate node set: '{name}'")
 
-            ids = bluepysnap.query.resolve_ids(cells, population, query)
-            if not allow_empty and ids.any():
+            if not allow_empty and _is_empty(query):
                 raise BrainBuilderError(f"Empty target: {name} {query}")
 
             result[name] = query
@@ -128,8 +227,8 @@ def create_node_sets(cells, full_hierarchy, atlas, targets, allow_empty, populat
         _add_node_sets(occupied_regions)
 
     if full_hierarchy:
-        region_map_df = atlas.load_region_map().as_dataframe()
-        _add_occupied_hierarchy(region_map_df, occupied_regions, result)
+        hierarchy = HierarchyIndex.from_region_map(atlas.load_region_map())
+        _add_occupied_hierarchy(hierarchy, occupied_regions, result)
 
     if targets is not None:
         query_based, atlas_based = load_targets(targets)
@@ -138,10 +237,9 @@ def create_node_sets(cells, full_hierarchy, atlas, targets, allow_empty, populat
             _add_node_sets(query_based)
 
         if atlas_based is not None:
-            xyz = cells[list("xyz")]
-            for name, dset in atlas_based.items():
-                mask = atlas.load_data(dset, cls=voxcell.ROIMask).lookup(xyz.to_numpy())
-                ids = xyz.index[mask] - 1  # CellCollection is 1 based, SONATA is 0 based
+            masks = lookup_atlas_masks(atlas, atlas_based, cells[list("xyz")].to_numpy())
+            for name, mask in masks.items():
+                ids = cells.index[mask] - 1  # CellCollection is 1 based, SONATA is 0 based
                 assert name not in result
                 result[name] = {"population": population, "node_id": ids.tolist()}
 
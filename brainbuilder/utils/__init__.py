@@ -1,13 +1,38 @@
 # SPDX-License-Identifier: Apache-2.0
-""" libraries of common functionality for circuit building """
+"""libraries of common functionality for circuit building"""
 
 import json
+import re
 
+import numpy as np
 import yaml
 
+# Number of values in the HDF5 chunks of the appendable datasets of unknown size
+DATASET_CHUNKSIZE = 1000
+# Target size in bytes of the HDF5 chunks of the appendable datasets of known size
+DATASET_CHUNK_BYTES = 1024**2
+# Size in bytes of the values buffered by an AppendableDatasetWriter before being written
+DATASET_BUFFER_BYTES = 64 * 1024**2
 
-def create_appendable_dataset(h5_root, name, dtype, chunksize=1000):
-    """create an h5 appendable dataset at `h5_root` w/ `name`"""
+
+def get_dataset_chunksize(dtype, expected_size=None):
+    """return the HDF5 chunk size of a 1D dataset of `dtype`, with `expected_size` values
+
+    Without `expected_size`, the chunks stay small, since the dataset may be small as well.
+    """
+    if expected_size is None:
+        return DATASET_CHUNKSIZE
+    chunksize = max(1, DATASET_CHUNK_BYTES // np.dtype(dtype).itemsize)
+    return max(1, min(chunksize, expected_size))
+
+
+def create_appendable_dataset(h5_root, name, dtype, chunksize=None, expected_size=None):
+    """create an h5 appendable dataset at `h5_root` w/ `name`
+
+    If `chunksize` is None, it's picked from `dtype` and the `expected_size` of the dataset.
+    """
+    if chunksize is None:
+        chunksize = get_dataset_chunksize(dtype, expected_size)
     h5_root.create_dataset(
         name,
         dtype=dtype,
@@ -18,11 +43,80 @@ def create_appendable_dataset(h5_root, name, dtype, chunksize=1000):
 
 
 def append_to_dataset(dset, values):
-    """append `values` to `dset`, which should be an appendable dataset"""
+    """append `values` to `dset`, which should be an appendable dataset
+
+    Note: the dataset is resized on each call; use `AppendableDatasetWriter` for many appends
+    """
     dset.resize(dset.shape[0] + len(values), axis=0)
     dset[-len(values) :] = values
 
 
+class AppendableDatasetWriter:
+    """Buffered writer appending values to an appendable dataset.
+
+    The appended values are kept in memory up to `buffer_bytes`, and written in bulk with a
+    single resize. If the `expected_size` of the dataset is known, the dataset is resized to
+    it upfront, and trimmed to the values actually written when the writer is closed.
+
+    Note: the dataset only contains the appended values once the writer is closed.
+    """
+
+    def __init__(self, dset, buffer_bytes=DATASET_BUFFER_BYTES, expected_size=None):
+        """Constructor
+
+        Args:
+            dset: h5py appendable dataset, as created by `create_appendable_dataset`
+            buffer_bytes: size in bytes of the values buffered before being written
+            expected_size: final size of the dataset, if known
+        """
+        self.dset = dset
+        self.size = dset.shape[0]
+        self.buffer_bytes = buffer_bytes
+        self._buffer = []
+        self._buffered_bytes = 0
+        if expected_size is not None and expected_size > self.size:
+            dset.resize(expected_size, axis=0)
+
+    @property
+    def buffered_bytes(self):
+        """Size in bytes of the values not written yet."""
+        return self._buffered_bytes
+
+    def append(self, values):
+        """Append `values` to the dataset."""
+        values = np.asarray(values, dtype=self.dset.dtype)
+        if len(values) == 0:
+            return
+        self._buffer.append(values)
+        self._buffered_bytes += values.nbytes
+        if self._buffered_bytes >= self.buffer_bytes:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered values to the dataset."""
+        if not self._buffer:
+            return
+        values = self._buffer[0] if len(self._buffer) == 1 else np.concatenate(self._buffer)
+        self._buffer, self._buffered_bytes = [], 0
+        stop = self.size + len(values)
+        if stop > self.dset.shape[0]:
+            self.dset.resize(stop, axis=0)
+        self.dset[self.size : stop] = values
+        self.size = stop
+
+    def close(self):
+        """Write the buffered values, and trim the dataset to the values written."""
+        self.flush()
+        if self.dset.shape[0] > self.size:
+            self.dset.resize(self.size, axis=0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 def load_json(filepath):
     """Load from JSON file."""
     with open(filepath, "r", encoding="utf-8") as f:
@@ -41,6 +135,32 @@ def dump_json(filepath, data, indent=2):
         json.dump(data, f, indent=indent)
 
 
+def dump_node_sets(filepath, node_sets, indent=2):
+    """Dump node sets to JSON file, with each 'node_id' list written on a single line.
+
+    Indenting 'node_id' lists puts every id on its own line, which makes the files of large
+    node sets several times bigger and much slower to write.
+    """
+    node_ids = {}
+
+    def _placeholder(rule):
+        if isinstance(rule, dict) and "node_id" in rule:
+            key = f"@node_id:{len(node_ids)}@"
+            node_ids[json.dumps(key)] = rule["node_id"]
+            rule = {**rule, "node_id": key}
+        return rule
+
+    content = json.dumps(
+        {name: _placeholder(rule) for name, rule in node_sets.items()}, indent=indent
+    )
+    parts = re.split(r'("@node_id:\d+@")', content)
+    with open(filepath, "w", encoding="utf-8") as f:
+        f.writelines(
+            json.dumps(node_ids[part], separators=(",", ":")) if part in node_ids else part
+            for part in parts
+        )
+
+
 def dump_yaml(filepath, data):
     """Dump to YAML file."""
     with open(filepath, "w", encoding="utf-8") as f:
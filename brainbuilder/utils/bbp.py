@@ -1,7 +1,12 @@
 # SPDX-License-Identifier: Apache-2.0
 """compatibility functions with existing BBP formats"""
 
+import contextlib
+import hashlib
 import logging
+import os
+import zipfile
+from pathlib import Path
 
 import h5py
 import lxml.etree
@@ -23,10 +28,80 @@ MECOMBO_EMODEL_COLUMNS = (
 
 L = logging.getLogger(__name__)
 
+# Environment variable naming the directory where the tables loaded by `_load_tsv` are cached
+TSV_CACHE_DIR_ENV = "BRAINBUILDER_TSV_CACHE_DIR"
+
+# To be bumped when the format of the cached tables changes
+TSV_CACHE_VERSION = 2
+
+# Number of cells processed at once when editing MVD3 files
+MVD3_CHUNK_SIZE = 1_000_000
+
+# Number of gids formatted at once when writing .target files
+GID_CHUNK_SIZE = 1_000_000
+
+
+def _tsv_cache_path(file, columns, dtype):
+    """Return the path of the cached table of `file`, None if caching is disabled."""
+    cache_dir = os.environ.get(TSV_CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+    # the dtypes of the parsed columns depend on the version of pandas
+    digest = hashlib.sha256(repr((TSV_CACHE_VERSION, pd.__version__, columns, dtype)).encode())
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 24), b""):
+            digest.update(block)
+    return Path(cache_dir, f"{Path(file).name}-{digest.hexdigest()}.npz")
+
+
+def _save_cached_table(path, df):
+    """Save `df` to `path` as numpy arrays, the string columns as categorical codes.
+
+    The string columns are the ones of object dtype, or of `StringDtype` since pandas 3.
+    """
+    arrays = {"dtypes": np.array([str(dtype) for dtype in df.dtypes])}
+    for i, column in enumerate(df.columns):
+        values = df[column]
+        if pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+            arrays[f"codes_{i}"], categories = pd.factorize(values)
+            arrays[f"categories_{i}"] = categories.to_numpy().astype(str)
+        else:
+            arrays[f"values_{i}"] = df[column].to_numpy()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def _load_cached_table(path, columns):
+    """Load a table saved by `_save_cached_table`."""
+    with np.load(path, allow_pickle=False) as arrays:
+        data = {}
+        for i, (column, dtype) in enumerate(zip(columns, arrays["dtypes"])):
+            if f"values_{i}" in arrays:
+                data[column] = arrays[f"values_{i}"]
+            else:
+                values = arrays[f"categories_{i}"].astype(object)[arrays[f"codes_{i}"]]
+                data[column] = values if dtype == "object" else pd.Series(values).astype(dtype)
+    return pd.DataFrame(data)
+
 
 def _load_tsv(file, columns, format_name, dtype=None):
+    """Load a whitespace separated table.
+
+    If the environment variable named by `TSV_CACHE_DIR_ENV` is set, the parsed table is cached
+    in that directory, keyed by the hash of the file content, and loaded from there next time.
+    """
+    cache_path = _tsv_cache_path(file, columns, dtype)
+    if cache_path is not None and cache_path.exists():
+        L.debug("Loading %s from %s", file, cache_path)
+        try:
+            return _load_cached_table(cache_path, columns)
+        except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            L.warning("Ignoring the unreadable cache %s of %s: %s", cache_path, file, e)
     try:
-        return pd.read_csv(
+        result = pd.read_csv(
             file,
             sep=r"\s+",
             names=columns,
@@ -36,6 +111,9 @@ def _load_tsv(file, columns, format_name, dtype=None):
         )
     except ParserError as e:
         raise ValueError(f"Invalid {format_name} format of {file}") from e
+    if cache_path is not None:
+        _save_cached_table(cache_path, result)
+    return result
 
 
 def load_neurondb(file):
@@ -116,12 +194,21 @@ def gid2str(gid):
     return f"a{gid}"
 
 
+def _write_gids(f, gids):
+    """Write `gids` formatted with `gid2str` and separated by spaces, one chunk at a time."""
+    gids = np.asarray(gids)
+    for start in range(0, len(gids), GID_CHUNK_SIZE):
+        # converting the whole chunk to python ints at once is faster than `gid2str` per gid
+        chunk = map(str, gids[start : start + GID_CHUNK_SIZE].tolist())
+        f.write(("a" if start == 0 else " a") + " a".join(chunk))
+
+
 def write_target(f, name, gids=None, include_targets=None):
     """Append contents to .target file."""
     f.write(f"\nTarget Cell {name}\n{{\n")
     if gids is not None:
         f.write("  ")
-        f.write(" ".join(map(gid2str, gids)))
+        _write_gids(f, gids)
         f.write("\n")
     if include_targets is not None:
         f.write("  ")
@@ -155,17 +242,24 @@ def assign_emodels(cells, morphdb):
     else:
         raise BrainBuilderError("Missing `layer` and `subregion` in cells dataframe")
 
-    df = df.join(morphdb.set_index(JOIN_COLS)[ME_COMBO], on=JOIN_COLS)
+    # number the join keys of the morphdb rows and of the cells together
+    keys = pd.concat([morphdb[JOIN_COLS], df[JOIN_COLS]], ignore_index=True)
+    key_codes = keys.groupby(JOIN_COLS, sort=False, dropna=False).ngroup().to_numpy()
+    morphdb_codes, cell_codes = key_codes[: len(morphdb)], key_codes[len(morphdb) :]
+
+    # the candidates of the key `k` are `candidates[offsets[k]:offsets[k] + counts[k]]`
+    candidates = morphdb[ME_COMBO].to_numpy()[np.argsort(morphdb_codes, kind="stable")]
+    counts = np.bincount(morphdb_codes, minlength=key_codes.max(initial=-1) + 1)
+    offsets = np.cumsum(counts) - counts
 
-    not_assigned = np.count_nonzero(df[ME_COMBO].isnull())
+    counts = counts[cell_codes]
+    not_assigned = np.count_nonzero(counts == 0)
     if not_assigned > 0:
         raise BrainBuilderError(f"Could not pick emodel for {not_assigned} cell(s)")
 
     # choose 'me_combo' randomly if several are available
-    df = df.sample(frac=1)
-    df = df[~df.index.duplicated(keep="first")]
-
-    df = df.sort_index()
+    picks = (np.random.random(len(df)) * counts).astype(np.int64)
+    df[ME_COMBO] = candidates[offsets[cell_codes] + picks]
 
     result = CellCollection.from_dataframe(df)
     result.population_name = cells.population_name
@@ -173,6 +267,89 @@ def assign_emodels(cells, morphdb):
     return result
 
 
+def _list_mvd3_datasets(h5f):
+    """Return the sorted names of the datasets of `/cells` of an opened MVD3 file."""
+    names = []
+    h5f["cells"].visititems(
+        lambda name, obj: names.append(name) if isinstance(obj, h5py.Dataset) else None
+    )
+    return sorted(names)
+
+
+def merge_mvd3(mvd3_paths, output_path, chunk_size=MVD3_CHUNK_SIZE):
+    """Merge MVD3 files, copying `chunk_size` cells at a time.
+
+    The library of each property is the sorted union of the libraries of the input files,
+    and the indices of each file are remapped to it while copied.
+    """
+    # pylint: disable=no-member,too-many-locals
+    if not mvd3_paths:
+        raise BrainBuilderError("No MVD3 file to merge")
+    str_dt = h5py.special_dtype(vlen=str)
+    with contextlib.ExitStack() as stack:
+        inputs = [stack.enter_context(h5py.File(path, "r")) for path in mvd3_paths]
+        names = _list_mvd3_datasets(inputs[0])
+        library_names = sorted(inputs[0].get("library", {}))
+        for path, h5f in zip(mvd3_paths, inputs):
+            libraries = sorted(h5f.get("library", {}))
+            if _list_mvd3_datasets(h5f) != names or libraries != library_names:
+                raise BrainBuilderError(f"{path} has different properties than {mvd3_paths[0]}")
+        libraries = {
+            name: np.unique(np.concatenate([h5f["library"][name].asstr()[:] for h5f in inputs]))
+            for name in library_names
+        }
+
+        output = stack.enter_context(h5py.File(output_path, "w"))
+        output.create_group("cells")
+        output.create_group("library")
+        for name, values in libraries.items():
+            output.create_dataset(f"library/{name}", data=values.astype(object), dtype=str_dt)
+
+        for name in names:
+            prop = name.split("/")[-1] if name.startswith("properties/") else None
+            first = inputs[0]["cells"][name]
+            total = sum(len(h5f["cells"][name]) for h5f in inputs)
+            dtype = np.uint32 if prop in libraries else first.dtype
+            out = output["cells"].create_dataset(
+                name, shape=(total,) + first.shape[1:], dtype=dtype
+            )
+            offset = 0
+            for h5f in inputs:
+                dset = h5f["cells"][name]
+                if prop in libraries:
+                    mapping = np.searchsorted(libraries[prop], h5f["library"][prop].asstr()[:])
+                elif h5py.check_string_dtype(dset.dtype):
+                    dset = dset.asstr()
+                for start in range(0, len(dset), chunk_size):
+                    values = dset[start : start + chunk_size]
+                    if prop in libraries:
+                        values = mapping[values]
+                    out[offset + start : offset + start + len(values)] = values
+                offset += len(dset)
+
+
+def add_mvd3_property(mvd3_path, prop, voxel_data, chunk_size=MVD3_CHUNK_SIZE):
+    """Add property `prop` to MVD3 file in place, from the values of `voxel_data` at the cells.
+
+    The positions are looked up `chunk_size` cells at a time, and only the dataset of `prop`
+    is written; an existing property `prop` is replaced.
+    """
+    # pylint: disable=no-member
+    with h5py.File(mvd3_path, "r+") as h5f:
+        positions = h5f["/cells/positions"]
+        name = f"/cells/properties/{prop}"
+        if name in h5f:
+            del h5f[name]
+        if f"/library/{prop}" in h5f:
+            del h5f[f"/library/{prop}"]
+        values = h5f.create_dataset(
+            name, shape=(len(positions),) + voxel_data.payload_shape, dtype=voxel_data.raw.dtype
+        )
+        for start in range(0, len(positions), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            values[chunk] = voxel_data.lookup(positions[chunk])
+
+
 def _parse_recipe(recipe_filename):
     """parse a BBP recipe and return the corresponding etree"""
     parser = lxml.etree.XMLParser(resolve_entities=False)
@@ -190,18 +367,30 @@ def _get_recipe_mtypes(recipe_path):
     return result
 
 
-def reorder_mtypes(mvd3_path, recipe_path):
-    """Re-order /library/mtypes to align with builder recipe."""
-    recipe_mtypes = _get_recipe_mtypes(recipe_path)
-    with h5py.File(mvd3_path, "a") as h5f:
-        mvd3_mtypes = h5f.pop("/library/mtype")[:]
-        mapping = np.zeros(len(mvd3_mtypes), dtype=np.uint8)
-        for k, mtype in enumerate(mvd3_mtypes):
-            mapping[k] = recipe_mtypes.index(mtype)
+def reorder_mtypes(mvd3_path, recipe_path, chunk_size=MVD3_CHUNK_SIZE):
+    """Re-order /library/mtypes to align with builder recipe.
 
-        mvd3_mtype_index = h5f.pop("/cells/properties/mtype")[:]
+    The MVD3 file is modified in place: `/cells/properties/mtype` is remapped with a lookup
+    table, `chunk_size` cells at a time, and only `/library/mtype` is rewritten.
+    """
+    # pylint: disable=no-member
+    recipe_mtypes = _get_recipe_mtypes(recipe_path)
+    with h5py.File(mvd3_path, "r+") as h5f:
+        mvd3_mtypes = h5f["/library/mtype"].asstr()[:]
+        mapping = np.array([recipe_mtypes.index(mtype) for mtype in mvd3_mtypes], dtype=np.int64)
+
+        mtype_index = h5f["/cells/properties/mtype"]
+        if len(recipe_mtypes) - 1 > np.iinfo(mtype_index.dtype).max:
+            raise BrainBuilderError(
+                f"{len(recipe_mtypes)} mtypes do not fit in the {mtype_index.dtype} mtype index"
+            )
+        if not np.array_equal(mapping, np.arange(len(mapping))):
+            for start in range(0, len(mtype_index), chunk_size):
+                chunk = slice(start, start + chunk_size)
+                mtype_index[chunk] = mapping[mtype_index[chunk]]
+
+        del h5f["/library/mtype"]
         dt = h5py.special_dtype(vlen=str)
-        h5f["/cells/properties/mtype"] = mapping[mvd3_mtype_index]
         h5f.create_dataset(
             "/library/mtype", data=np.asarray(recipe_mtypes).astype(object), dtype=dt
         )
@@ -1,10 +1,16 @@
 # SPDX-License-Identifier: Apache-2.0
-""" Utilities for random sampling. """
+"""Utilities for random sampling."""
 
 import json
+from functools import lru_cache
 
+import numpy as np
+import scipy.special
 import scipy.stats
 
+# Number of distribution objects kept in cache
+DISTR_CACHE_SIZE = 1024
+
 
 def _get_value(mapping, keys):
     """Return the value of the first key from `keys` found in `mapping`."""
@@ -14,36 +20,118 @@ def _get_value(mapping, keys):
     raise KeyError(keys)
 
 
-def parse_distr(value):
-    """
-    Convert distribution config into `scipy.stats` distribution object.
-
-    `value` can be either:
-        - a tuple (<distribution name>, <distribution parameters>)
-        - a string with JSON serialization of such a tuple
-
-    See also:
-    https://bbpteam.epfl.ch/project/spaces/display/BBPNSE/Defining+distributions+in+config+files
-    """
+def _normalize_distr(value):
+    """Return the `scipy.stats` distribution name and parameters of a distribution config."""
     if isinstance(value, str):
         value = json.loads(value)
     func, params = value
     if func in ("norm", "normal"):
         loc = _get_value(params, ("mean", "loc"))
         scale = _get_value(params, ("sd", "scale"))
-        return scipy.stats.norm(loc=loc, scale=scale)
+        return "norm", {"loc": loc, "scale": scale}
     elif func in ("truncnorm", "truncnormal"):
         loc = _get_value(params, ("mean", "loc"))
         scale = _get_value(params, ("sd", "scale"))
         a = _get_value(params, ("a", "low"))
         b = _get_value(params, ("b", "high"))
-        return scipy.stats.truncnorm(a=a, b=b, loc=loc, scale=scale)
+        return "truncnorm", {"a": a, "b": b, "loc": loc, "scale": scale}
     elif func in ("unif", "uniform"):
         a = _get_value(params, ("a", "low"))
         b = _get_value(params, ("b", "high"))
         loc = min(a, b)
         scale = max(a, b) - loc
-        return scipy.stats.uniform(loc=loc, scale=scale)
+        return "uniform", {"loc": loc, "scale": scale}
     else:
         # Try to instantiate a distribution directly from `scipy.stats`, w/o parameter guessing
-        return getattr(scipy.stats, func)(**params)
+        return func, params
+
+
+def _scalar(value):
+    """Return the Python scalar of a numpy scalar, other values unchanged."""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _distr_key(value):
+    """Return a hashable key of a distribution config, or None if it has none.
+
+    numpy scalar parameters are converted to the equivalent Python scalars.
+    """
+    if isinstance(value, str):
+        return value
+    try:
+        func, params = value
+        key = (func, tuple(sorted((k, _scalar(v)) for k, v in params.items())))
+        hash(key)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return key
+
+
+@lru_cache(maxsize=DISTR_CACHE_SIZE)
+def _frozen_distr(key):
+    """Return the `scipy.stats` distribution object of a distribution config `key`."""
+    value = key if isinstance(key, str) else (key[0], dict(key[1]))
+    name, params = _normalize_distr(value)
+    return getattr(scipy.stats, name)(**params)
+
+
+def parse_distr(value):
+    """
+    Convert distribution config into `scipy.stats` distribution object.
+
+    `value` can be either:
+        - a tuple (<distribution name>, <distribution parameters>)
+        - a string with JSON serialization of such a tuple
+
+    The distribution objects are cached, and shared by the calls with the same config:
+    pass the random state to their methods instead of setting their `random_state`.
+
+    See also:
+    https://bbpteam.epfl.ch/project/spaces/display/BBPNSE/Defining+distributions+in+config+files
+    """
+    key = _distr_key(value)
+    if key is None:
+        name, params = _normalize_distr(value)
+        return getattr(scipy.stats, name)(**params)
+    return _frozen_distr(key)
+
+
+def _sample_truncnorm(rng, params, size):
+    """Sample a truncated normal distribution by inverting its CDF."""
+    a, b = params["a"], params["b"]
+    # sample the side of the distribution with the lowest tail, where the CDF is precise
+    flip = a > 0
+    if flip:
+        a, b = -b, -a
+    # pylint: disable=no-member
+    values = scipy.special.ndtri(rng.uniform(scipy.special.ndtr(a), scipy.special.ndtr(b), size))
+    return params["loc"] + params["scale"] * (-values if flip else values)
+
+
+def sample_distr(value, size, rng=None):
+    """
+    Draw samples from a distribution config.
+
+    Normal, truncated normal and uniform distributions are sampled directly with `rng`,
+    without the overhead of `scipy.stats`; other distributions use `parse_distr`.
+
+    Args:
+        value: distribution config, see `parse_distr`
+        size: number of samples
+        rng: a `numpy.random.Generator`; the global numpy random state is used if None
+
+    Returns:
+        (size,) array of samples
+    """
+    distr = parse_distr(value)
+    name, params = distr.dist.name, distr.kwds
+    # the functions of `numpy.random` draw from the global random state
+    generator = np.random if rng is None else rng
+    if name == "norm":
+        return generator.normal(params["loc"], params["scale"], size)
+    elif name == "truncnorm":
+        return _sample_truncnorm(generator, params, size)
+    elif name == "uniform":
+        return generator.uniform(params["loc"], params["loc"] + params["scale"], size)
+    else:
+        return distr.rvs(size=size, random_state=rng)
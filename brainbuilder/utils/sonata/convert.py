@@ -5,6 +5,8 @@ Temporary SONATA converters.
 https://github.com/AllenInstitute/sonata/blob/master/docs/SONATA_DEVELOPER_GUIDE.md
 """
 
+import array
+import itertools
 import logging
 import os
 import re
@@ -15,10 +17,16 @@ import pandas as pd
 from voxcell import CellCollection
 
 from brainbuilder.exceptions import BrainBuilderError
-from brainbuilder.utils import dump_json
+from brainbuilder.utils import dump_node_sets
 
 L = logging.getLogger("brainbuilder")
 
+# Number of characters read at once when parsing .target files
+TARGET_READ_SIZE = 1 << 20
+
+TARGET_TOKEN_RE = re.compile(r"[{}]|[^\s{}]+")
+GID_RE = re.compile(r"^a\d+$")
+
 
 def _add_me_info(cells, mecombo_info):
     assert not mecombo_info.duplicated(
@@ -157,64 +165,93 @@ def write_edges_from_syn2(syn2_path, population, source, target, out_h5_path):
             )
 
 
+def _sorted_unique(ids):
+    """Return `ids` as a sorted array without duplicates, sorting it only if needed."""
+    ids = np.asarray(ids)
+    if np.all(ids[1:] > ids[:-1]):
+        return ids
+    return np.unique(ids)
+
+
 def validate_node_set(node_set, cells):
-    """Validate a node_set file"""
+    """Validate a node_set file
 
-    def get_ids(cells, node_set, target):
-        """Get ids for a target."""
+    The ids of every target are resolved once, as sorted unique arrays, and reused by the
+    compound targets referring to it; comparing sorted unique arrays is then linear.
+    """
+    resolved = {}
+
+    def get_ids(target):
+        """Get sorted unique ids for a target."""
         if isinstance(target, list):
-            return np.hstack([get_ids(cells, node_set, node_set[t]) for t in target])
+            ids = [get_named_ids(t) for t in target]
+            return _sorted_unique(np.concatenate(ids)) if ids else np.array([], dtype=np.int64)
         if "node_id" in target:
-            return np.array(target["node_id"]) + 1
-        return cells.ids(target)
+            return _sorted_unique(np.array(target["node_id"]) + 1)
+        return _sorted_unique(cells.ids(target))
+
+    def get_named_ids(name):
+        """Get sorted unique ids for a target of the node_set."""
+        if name not in resolved:
+            resolved[name] = get_ids(node_set[name])
+        return resolved[name]
 
-    for name, target in node_set.items():
+    for name in node_set:
         L.info("Validating %s...", name)
-        target_ids = cells.ids(name)
-        node_set_ids = get_ids(cells, node_set, target)
-        if (
-            np.setdiff1d(target_ids, node_set_ids).size > 0
-            or np.setdiff1d(node_set_ids, target_ids).size > 0
-        ):
+        target_ids = _sorted_unique(cells.ids(name))
+        if not np.array_equal(target_ids, get_named_ids(name)):
             raise BrainBuilderError(f"Target {name} differs in target file and node set file")
 
 
-def _parse_targets(target_files):
-    """Return a dict of all targets.
+def _iter_target_tokens(filepath):
+    """Yield the tokens of a .target file, reading it by blocks; braces are tokens of their own."""
+    with open(filepath, "r", encoding="utf-8") as f:
+        rest = ""
+        for block in iter(lambda: f.read(TARGET_READ_SIZE), ""):
+            block = rest + block
+            tokens = TARGET_TOKEN_RE.findall(block)
+            # the last token may go on in the next block
+            rest = tokens.pop() if tokens and TARGET_TOKEN_RE.match(block[-1]) else ""
+            yield from tokens
+        if rest:
+            yield rest
+
 
-    This function basically repeats the implementation of targets for bluepy<2.4.1. As of 2.4.1
-    the implementation is optimized to reduce memory. That's why the unoptimized implementation
-    is kept here for conversion purposes only.
+def _parse_target_file(filepath):
+    """Parse .target file, yield the name, the gids and the included targets of each target.
+
+    The gids are returned as an int64 array.
     """
+    tokens = _iter_target_tokens(filepath)
+    for token in tokens:
+        if token != "Target":
+            continue
+        header = list(itertools.islice(tokens, 3))  # type, name and start brace
+        if len(header) < 3 or header[2] != "{":
+            continue
+        gids, include_targets = array.array("q"), []
+        for content in tokens:
+            if content == "}":
+                yield header[1], np.frombuffer(gids, dtype=np.int64), include_targets
+                break
+            if GID_RE.match(content):
+                gids.append(int(content[1:]))
+            else:
+                include_targets.append(content)
 
-    def _parse_target_file(filepath):
-        """Parse .target file, return generator of `Target`s."""
-        with open(filepath, "r", encoding="utf-8") as f:
-            contents = f.read()
-
-        target_regex = re.compile(
-            r"""
-            Target               # Start token
-            \s+                  # 1 or more whitespace
-            (?P<type>\S+)        # type
-            \s+                  # 1 or more whitespace
-            (?P<name>\S+)        # name
-            \s+                  # 1 or more whitespace
-            (?P<start>\{)        # start brace
-            (?P<contents>[^}]*)  # not the end brace (contents is needed by brainbuilder)
-            (?P<end>})           # end brace
-            """,
-            re.VERBOSE | re.MULTILINE | re.DOTALL,
-        )
-        for m in target_regex.finditer(contents):
-            yield m.group("name"), m.group("contents").strip().split()
 
+def _parse_targets(target_files):
+    """Return a dict of all targets: name -> (gids, include_targets).
+
+    The target files are parsed as a stream of tokens, and the gids are stored as int64 arrays,
+    to keep the memory usage low for targets with millions of gids.
+    """
     targets = {}
     for file in target_files:
-        for target_name, target_content in _parse_target_file(file):
+        for target_name, gids, include_targets in _parse_target_file(file):
             if target_name in targets:
                 raise BrainBuilderError(f"{target_name} is duplicated, please check target files")
-            targets[target_name] = target_content
+            targets[target_name] = gids, include_targets
 
     return targets
 
@@ -249,29 +286,31 @@ def write_node_set_from_targets(target_files, output_file, cells_path):
 
     targets = _parse_targets(target_files)
     re_layer = re.compile(r"^layer(\d)$", re.IGNORECASE)
-    re_node_id = re.compile(r"^a\d+$")
 
-    def target_to_node_set_entry(target_name, target_content):
+    def target_to_node_set_entry(target_name, gids, include_targets):
         L.info("Converting %s...", target_name)
         if target_name in mapping:
             return mapping[target_name]
         if re_layer.match(target_name):
             return {"layer": str(re_layer.match(target_name).group(1))}
-        if re_node_id.match(target_content[0]):
+        if len(gids) > 0:
             L.warning(
                 "Note: a list of `node_id`s are being created, "
                 "the %s node_set should have a population added",
                 target_name,
             )
+            if include_targets:
+                gids = cells.ids(target_name)
             # targets are built from a mvd3 file so indexing starts from 1 compare to 0 in SONATA
-            return {"node_id": (cells.ids(target_name) - 1).tolist()}
+            return {"node_id": (np.unique(gids) - 1).tolist()}
 
-        return list(set(target_content))
+        return list(set(include_targets))
 
     output_dict = {
-        name: target_to_node_set_entry(name, contents) for name, contents in targets.items()
+        name: target_to_node_set_entry(name, gids, include_targets)
+        for name, (gids, include_targets) in targets.items()
     }
 
     validate_node_set(output_dict, cells)
 
-    dump_json(output_file, output_dict)
+    dump_node_sets(output_file, output_dict)
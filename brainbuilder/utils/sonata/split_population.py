@@ -1,20 +1,23 @@
 # SPDX-License-Identifier: Apache-2.0
 """Split a SONATA node/edge population into sub-populations"""
 
+# pylint: disable=too-many-lines
+
 import collections
 import copy
 import itertools as it
 import logging
+import multiprocessing
 import os
+import tempfile
+from functools import partial
 from pathlib import Path
 
 import bluepysnap
 import h5py
 import libsonata
 import numpy as np
-import pandas as pd
 import voxcell
-from joblib import Parallel, delayed
 
 from brainbuilder import utils
 from brainbuilder.utils.sonata import curate
@@ -23,8 +26,16 @@ L = logging.getLogger(__name__)
 
 # So as not to exhaust memory, the edges files are loaded/written in chunks of this size
 H5_READ_CHUNKSIZE = 500_000_000
+# The edge ranges of the selected target nodes closer than this are read at once, since
+# reading a few more edges is cheaper than an additional h5 read
+EDGE_RANGES_MAX_GAP = 100_000
 # Name of the unique expected group in sonata nodes and edges files
 GROUP_NAME = "0"
+# Maximum number of edge files written at once by `_scatter_edges`, so as not to exhaust the
+# file descriptors, and the memory used by the HDF5 chunk caches and the write buffers
+MAX_OPEN_EDGE_FILES = 256
+# Default maximum number of processes writing the edge files in `split_subcircuit`
+DEFAULT_MAX_WORKERS = min(4, os.cpu_count() or 1)
 # Sentinel to mark an edge file being empty
 DELETED_EMPTY_EDGES_FILE = "DELETED_EMPTY_EDGES_FILE"
 
@@ -34,36 +45,91 @@ def _create_chunked_slices(length, chunk_size):
     return (slice(start, start + chunk_size) for start in range(0, length, chunk_size))
 
 
-def _isin_worker(elements, test_elements, sl, invert):
-    """worker for parallelized version of nump.isin"""
-    return np.isin(elements[sl], test_elements, invert=invert)
-
+def _create_read_slices(length, chunk_size, edge_ranges=None):
+    """return the slices of at most `chunk_size` edges to read
 
-def _isin(elements, test_elements, invert=False):
-    """parallelized version of nump.isin"""
-    h5_chunksize = _h5_get_read_chunk_size()
+    All the `length` edges are read if `edge_ranges` is None, otherwise only the sorted
+    `edge_ranges`, the ones closer than EDGE_RANGES_MAX_GAP being read together.
+    """
+    if edge_ranges is None:
+        return _create_chunked_slices(length, chunk_size)
 
-    if len(elements) < h5_chunksize:
-        return np.isin(elements, test_elements, invert=invert)
+    windows = []
+    for start, stop in edge_ranges:
+        if windows and start - windows[-1][1] <= EDGE_RANGES_MAX_GAP:
+            windows[-1][1] = max(windows[-1][1], stop)
+        else:
+            windows.append([start, stop])
 
-    parallel = Parallel(
-        backend="loky",
-        n_jobs=-2,
-        # verbose=51,
+    return (
+        slice(start + sl.start, min(start + sl.stop, stop))
+        for start, stop in windows
+        for sl in _create_chunked_slices(stop - start, chunk_size)
     )
 
-    # arbitrary chunk_size; 1e6 with the default H5_READ_CHUNKSIZE seems about right
-    chunk_size = max(500, int(h5_chunksize / 500))
-    ret = parallel(
-        delayed(_isin_worker)(elements, test_elements, sl, invert)
-        for sl in _create_chunked_slices(len(elements), chunk_size)
+
+def _get_afferent_edge_ranges(orig_edges, node_ids):
+    """return the sorted ranges of the edges of `orig_edges` targeting `node_ids`
+
+    The ranges are read from the SONATA indices; None is returned if `orig_edges` isn't
+    indexed, in which case all the edges have to be read.
+    """
+    if "target_to_source" not in orig_edges.get("indices", {}):
+        return None
+    population = libsonata.EdgeStorage(orig_edges.file.filename).open_population(
+        orig_edges.name.split("/")[-1]
     )
+    return sorted(population.afferent_edges(np.asarray(node_ids, dtype=np.int64)).ranges)
+
+
+def _create_membership_table(ids):
+    """return a dense boolean table indexed by node id, True for the given `ids`
 
-    ret = np.concatenate(ret)
+    SONATA node ids are dense, so the membership of edge endpoints can be tested with
+    `_lookup_membership`, which is a plain gather instead of the sort done by `np.isin`.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    table = np.zeros(int(ids.max()) + 1 if len(ids) else 0, dtype=bool)
+    table[ids] = True
+    return table
+
+
+def _lookup_membership(table, ids, invert=False):
+    """return a mask of the `ids` that are set in the membership `table`"""
+    ids = np.asarray(ids, dtype=np.int64)
+    mask = ids < len(table)
+    mask[mask] = table[ids[mask]]
+    return ~mask if invert else mask
+
+
+def _create_id_mapping(old_ids):
+    """return a dense id mapping, from the old ids to their positions in `old_ids`
 
+    An id mapping is an int64 array indexed by old node id, holding the new node id, or -1
+    for the nodes that are not selected.
+    """
+    old_ids = np.asarray(old_ids, dtype=np.int64)
+    assert (old_ids >= 0).all(), "Node ids must be positive."
+    id_mapping = np.full(int(old_ids.max()) + 1 if len(old_ids) else 0, -1, dtype=np.int64)
+    id_mapping[old_ids] = np.arange(len(old_ids), dtype=np.int64)
+    return id_mapping
+
+
+def _map_ids(id_mapping, ids):
+    """return the new ids of `ids` in `id_mapping`, -1 for the ids that are not selected"""
+    ids = np.asarray(ids, dtype=np.int64)
+    ret = np.full(len(ids), -1, dtype=np.int64)
+    inside = ids < len(id_mapping)
+    ret[inside] = id_mapping[ids[inside]]
     return ret
 
 
+def _get_mapped_ids(id_mapping):
+    """return the sorted old ids selected in `id_mapping`, and their new ids"""
+    old_ids = np.flatnonzero(id_mapping >= 0)
+    return old_ids, id_mapping[old_ids]
+
+
 def _get_population_name(src, dst, synapse_type="chemical"):
     """Return the population name based off `src` and `dst` node population names."""
     return src if src == dst else f"{src}__{dst}__{synapse_type}"
@@ -141,26 +207,70 @@ def _init_edge_group(orig_group, new_group):
             raise ValueError('Only "dynamics_params" group is expected')
 
 
-def _populate_edge_group(orig_group, new_group, sl, mask):
-    """Populate the datasets from orig_group to new_group.
+def _scatter_edge_group(orig_group, writers, sl, selections):
+    """Populate the groups of the new edge populations, reading the datasets of orig_group once.
 
     Args:
         orig_group (h5py.Group): original group, e.g. /edges/default/0
-        new_group (h5py.Group): new group, e.g. /edges/L2_X__L6_Y__chemical/0
+        writers (dict): key -> writers of a new edge population, see `_create_edge_writers`
         sl (slice): slice used to select the dataset range
-        mask (np.ndarray): mask used to filter the dataset
+        selections (dict): key -> indices or mask of the edges of the range to copy to
+            the new edge population of writers[key]
     """
     for name, attr in orig_group.items():
         if isinstance(attr, h5py.Dataset):
-            utils.append_to_dataset(new_group[name], attr[sl][mask])
+            values = attr[sl]
+            for key, indices in selections.items():
+                writers[key][f"{GROUP_NAME}/{name}"].append(values[indices])
         elif isinstance(attr, h5py.Group) and name == "dynamics_params":
-            for k, values in attr.items():
-                if isinstance(values, h5py.Dataset):
-                    utils.append_to_dataset(new_group[name][k], values[sl][mask])
+            for k, dset in attr.items():
+                if isinstance(dset, h5py.Dataset):
+                    values = dset[sl]
+                    for key, indices in selections.items():
+                        writers[key][f"{GROUP_NAME}/{name}/{k}"].append(values[indices])
         else:
             raise ValueError('Only "dynamics_params" group is expected')
 
 
+def _create_edge_population(h5out, orig_group, src_node_name, dst_node_name, dst_edge_name):
+    """Create the empty edge population `dst_edge_name` in `h5out`, and return it."""
+    new_edges = h5out.create_group("edges/" + dst_edge_name)
+    new_group = new_edges.create_group(GROUP_NAME)
+
+    utils.create_appendable_dataset(new_edges, "source_node_id", np.uint64)
+    utils.create_appendable_dataset(new_edges, "target_node_id", np.uint64)
+
+    new_edges["source_node_id"].attrs["node_population"] = src_node_name
+    new_edges["target_node_id"].attrs["node_population"] = dst_node_name
+
+    _init_edge_group(orig_group, new_group)
+    return new_edges
+
+
+def _create_edge_writers(new_edges):
+    """return buffered writers of all the datasets of `new_edges`, by path relative to it"""
+    writers = {}
+
+    def _add_writer(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            writers[name] = utils.AppendableDatasetWriter(obj)
+
+    new_edges.visititems(_add_writer)
+    return writers
+
+
+def _flush_edge_writers(all_writers):
+    """write the values buffered by `all_writers` if together they exceed the buffer size
+
+    The writers of many new edge populations may be alive at once, so their buffers are
+    bounded as a whole.
+    """
+    writers = [writer for writers in all_writers for writer in writers.values()]
+    if sum(writer.buffered_bytes for writer in writers) >= utils.DATASET_BUFFER_BYTES:
+        for writer in writers:
+            writer.flush()
+
+
 def _finalize_edges(new_edges):
     """add datasets for `new_edges` so they fulfil SONATA spec"""
     edge_count = len(new_edges["source_node_id"])
@@ -184,47 +294,43 @@ def _copy_edge_attributes(  # pylint: disable=too-many-arguments
     src_mapping,
     dst_mapping,
     h5_read_chunk_size=None,
+    use_indices=False,
 ):
-    """Copy the attributes from the original edges into the new edge populations"""
+    """Copy the attributes from the original edges into the new edge populations
+
+    If `use_indices`, only the edges targeting the nodes of `dst_mapping` are read, using
+    the SONATA indices of the original edges when they exist.
+    """
     # pylint: disable=too-many-locals
     if h5_read_chunk_size is None:
         h5_read_chunk_size = _h5_get_read_chunk_size()
 
     orig_edges = h5in["edges"][src_edge_name]
     orig_group = _get_unique_group(orig_edges)
-    new_edges = h5out.create_group("edges/" + dst_edge_name)
-    new_group = new_edges.create_group(GROUP_NAME)
-
-    utils.create_appendable_dataset(new_edges, "source_node_id", np.uint64)
-    utils.create_appendable_dataset(new_edges, "target_node_id", np.uint64)
-
-    new_edges["source_node_id"].attrs["node_population"] = src_node_name
-    new_edges["target_node_id"].attrs["node_population"] = dst_node_name
-
-    _init_edge_group(orig_group, new_group)
+    new_edges = _create_edge_population(
+        h5out, orig_group, src_node_name, dst_node_name, dst_edge_name
+    )
+    writers = _create_edge_writers(new_edges)
 
-    sgids_new = src_mapping.index.to_numpy()
-    tgids_new = dst_mapping.index.to_numpy()
-    assert (sgids_new >= 0).all(), "Source population ids must be positive."
-    assert (tgids_new >= 0).all(), "Target population ids must be positive."
+    edge_ranges = None
+    if use_indices:
+        edge_ranges = _get_afferent_edge_ranges(orig_edges, _get_mapped_ids(dst_mapping)[0])
 
-    for sl in _create_chunked_slices(len(orig_edges["source_node_id"]), h5_read_chunk_size):
-        sgids = orig_edges["source_node_id"][sl]
-        tgids = orig_edges["target_node_id"][sl]
-        sgid_mask = _isin(sgids, sgids_new)
-        tgid_mask = _isin(tgids, tgids_new)
+    edge_count = len(orig_edges["source_node_id"])
+    for sl in _create_read_slices(edge_count, h5_read_chunk_size, edge_ranges):
+        sgids = _map_ids(src_mapping, orig_edges["source_node_id"][sl])
+        tgids = _map_ids(dst_mapping, orig_edges["target_node_id"][sl])
 
-        mask = sgid_mask & tgid_mask
+        mask = (sgids >= 0) & (tgids >= 0)
 
         if np.any(mask):
-            utils.append_to_dataset(
-                new_edges["source_node_id"], src_mapping.loc[sgids[mask]].new_id.to_numpy()
-            )
-            utils.append_to_dataset(
-                new_edges["target_node_id"], dst_mapping.loc[tgids[mask]].new_id.to_numpy()
-            )
-            _populate_edge_group(orig_group, new_group, sl, mask)
+            writers["source_node_id"].append(sgids[mask])
+            writers["target_node_id"].append(tgids[mask])
+            _scatter_edge_group(orig_group, {0: writers}, sl, {0: mask})
+            _flush_edge_writers([writers])
 
+    for writer in writers.values():
+        writer.close()
     _finalize_edges(new_edges)
 
 
@@ -257,41 +363,185 @@ def _check_all_edges_used(h5in, written_edges):
         )
 
 
+def _get_node_groups(node_ids):
+    """return dense arrays of the population position and of the new id of all the old ids
+
+    Args:
+        node_ids(dict): population name -> old ids of its nodes, the new ids being their
+            positions; the populations must be disjoint subsets of the same node population
+
+    Both arrays are indexed by old node id, and hold -1 for the nodes that are not selected;
+    they are shared by all the populations, so that their size does not grow with the number
+    of populations.
+    """
+    size = max((int(ids.max()) + 1 for ids in node_ids.values() if len(ids)), default=0)
+    groups = np.full(size, -1, dtype=np.int64)
+    new_ids = np.full(size, -1, dtype=np.int64)
+    for i, old_ids in enumerate(node_ids.values()):
+        assert (old_ids >= 0).all(), "Node ids must be positive."
+        assert (groups[old_ids] == -1).all(), "Node populations must be disjoint."
+        groups[old_ids] = i
+        new_ids[old_ids] = np.arange(len(old_ids), dtype=np.int64)
+    return groups, new_ids
+
+
+def _get_edge_selections(src_groups, dst_groups, group_count):
+    """return a dict of (src group, dst group) -> indices of the edges going between them"""
+    codes = np.where(
+        (src_groups >= 0) & (dst_groups >= 0), src_groups * group_count + dst_groups, -1
+    )
+    # the sort is stable, so that the edges keep their order in each selection
+    order = np.argsort(codes, kind="stable")
+    unique_codes, starts = np.unique(codes[order], return_index=True)
+    stops = np.append(starts[1:], len(order))
+    return {
+        divmod(int(code), group_count): order[start:stop]
+        for code, start, stop in zip(unique_codes, starts, stops)
+        if code >= 0
+    }
+
+
+def _scatter_edges_batch(
+    output,
+    orig_edges,
+    populations,
+    node_groups,
+    dst_groups,
+    node_new_ids,
+    h5_read_chunk_size,
+    use_indices,
+):
+    """write the edges of `orig_edges` targeting the nodes of `dst_groups`, in one pass
+
+    Args:
+        output(str): base directory to write edge files
+        orig_edges(h5py.Group): original edge population
+        populations(list): new node population names
+        node_groups(np.array): population positions of all the old ids, see `_get_node_groups`
+        dst_groups(np.array): same as `node_groups`, restricted to the target populations
+        node_new_ids(np.array): new ids of all the old ids, see `_get_node_groups`
+        h5_read_chunk_size(int): number of edges read at once
+        use_indices(bool): read only the edges targeting `dst_groups`, using the SONATA indices
+
+    Returns:
+        set: the (source, target) population positions of the new edge populations written
+    """
+    # pylint: disable=too-many-locals
+    orig_group = _get_unique_group(orig_edges)
+
+    edge_ranges = None
+    if use_indices:
+        edge_ranges = _get_afferent_edge_ranges(orig_edges, np.flatnonzero(dst_groups >= 0))
+
+    edge_count = len(orig_edges["source_node_id"])
+    outputs, writers = {}, {}
+    try:
+        for sl in _create_read_slices(edge_count, h5_read_chunk_size, edge_ranges):
+            sgids = orig_edges["source_node_id"][sl]
+            tgids = orig_edges["target_node_id"][sl]
+            selections = _get_edge_selections(
+                _map_ids(node_groups, sgids), _map_ids(dst_groups, tgids), len(populations)
+            )
+            sgids = _map_ids(node_new_ids, sgids)
+            tgids = _map_ids(node_new_ids, tgids)
+
+            for key, indices in selections.items():
+                if key not in outputs:
+                    src_node_pop, dst_node_pop = populations[key[0]], populations[key[1]]
+                    edge_pop_name = _get_population_name(src_node_pop, dst_node_pop)
+                    edge_file_name = os.path.join(output, _get_edge_file_name(edge_pop_name))
+                    L.debug("Writing to  %s", edge_file_name)
+                    h5out = h5py.File(edge_file_name, "w")
+                    outputs[key] = h5out, _create_edge_population(
+                        h5out, orig_group, src_node_pop, dst_node_pop, edge_pop_name
+                    )
+                    writers[key] = _create_edge_writers(outputs[key][1])
+                writers[key]["source_node_id"].append(sgids[indices])
+                writers[key]["target_node_id"].append(tgids[indices])
+
+            _scatter_edge_group(orig_group, writers, sl, selections)
+            _flush_edge_writers(writers.values())
+
+        for key, (_, new_edges) in outputs.items():
+            for writer in writers[key].values():
+                writer.close()
+            _finalize_edges(new_edges)
+    finally:
+        for h5out, _ in outputs.values():
+            h5out.close()
+
+    return set(outputs)
+
+
+def _scatter_edges(output, h5in, node_ids, h5_read_chunk_size, use_indices=False):
+    """write the edges of `h5in` to the files of all the new edge populations
+
+    Each chunk of edges is read once per batch of target populations, and the edges are
+    grouped by their source and target node populations before being appended to the
+    corresponding files. The batches are sized so that at most MAX_OPEN_EDGE_FILES files
+    are open at once. If `use_indices`, only the edges targeting the nodes of the batch
+    are read, using the SONATA indices.
+
+    Returns:
+        set: the (source, target) node population names of the new edge populations written
+    """
+    populations = list(node_ids)
+    node_groups, node_new_ids = _get_node_groups(node_ids)
+    orig_edges = h5in["edges"][_get_unique_population(h5in["edges"])]
+
+    batch_size = max(1, MAX_OPEN_EDGE_FILES // max(1, len(populations)))
+    written = set()
+    for start in range(0, len(populations), batch_size):
+        in_batch = (node_groups >= start) & (node_groups < start + batch_size)
+        written |= _scatter_edges_batch(
+            output,
+            orig_edges,
+            populations,
+            node_groups,
+            np.where(in_batch, node_groups, -1),
+            node_new_ids,
+            h5_read_chunk_size,
+            use_indices,
+        )
+
+    return {(populations[src], populations[dst]) for src, dst in written}
+
+
 def _write_edges(
     output,
     edges_path,
-    id_mapping,
+    node_ids,
     h5_read_chunk_size=None,
     expect_to_use_all_edges=True,
+    use_indices=False,
 ):
-    """create all new edge populations in separate files"""
+    """create all new edge populations in separate files
+
+    `node_ids` is a dict of the new population name -> old ids of its nodes, see
+    `_get_node_ids`. If `use_indices`, only the edges targeting these nodes are read, using
+    the SONATA indices of the edges when they exist.
+    """
+    # pylint: disable=too-many-locals
+    if h5_read_chunk_size is None:
+        h5_read_chunk_size = _h5_get_read_chunk_size()
+
     with h5py.File(edges_path, "r") as h5in:
+        written = _scatter_edges(output, h5in, node_ids, h5_read_chunk_size, use_indices)
+
         written_edges = 0
-        for src_node_pop, dst_node_pop in it.product(id_mapping, id_mapping):
+        for src_node_pop, dst_node_pop in it.product(node_ids, node_ids):
             edge_pop_name = _get_population_name(src_node_pop, dst_node_pop)
             edge_file_name = os.path.join(output, _get_edge_file_name(edge_pop_name))
 
-            L.debug("Writing to  %s", edge_file_name)
-            with h5py.File(edge_file_name, "w") as h5out:
-                _copy_edge_attributes(
-                    h5in=h5in,
-                    h5out=h5out,
-                    src_node_name=src_node_pop,
-                    dst_node_name=dst_node_pop,
-                    src_edge_name=_get_unique_population(h5in["edges"]),
-                    dst_edge_name=edge_pop_name,
-                    src_mapping=id_mapping[src_node_pop],
-                    dst_mapping=id_mapping[dst_node_pop],
-                    h5_read_chunk_size=h5_read_chunk_size,
-                )
-                edge_count, sgid_count, tgid_count = _get_node_counts(h5out, edge_pop_name)
-
-            # after the h5 file is closed, it's indexed if valid, or it's removed if empty
-            if edge_count > 0:
+            # after the h5 file is closed, it's indexed if valid; a file left by a previous
+            # run is removed if empty, since the circuit config lists the existing files
+            if (src_node_pop, dst_node_pop) in written:
+                with h5py.File(edge_file_name, "r") as h5out:
+                    edge_count, sgid_count, tgid_count = _get_node_counts(h5out, edge_pop_name)
                 _write_indexes(edge_file_name, edge_pop_name, sgid_count, tgid_count)
                 L.debug("Wrote %s edges to %s", edge_count, edge_file_name)
                 written_edges += edge_count
-            else:
+            elif os.path.exists(edge_file_name):
                 os.unlink(edge_file_name)
 
         if expect_to_use_all_edges:
@@ -322,9 +572,21 @@ def _write_nodes(output, split_nodes, population_to_path=None):
 
 
 def _get_node_id_mapping(split_nodes):
-    """return a dict split_nodes.keys() -> DataFrame with index old_ids, and colunm new_id"""
+    """return a dict split_nodes.keys() -> id mapping of the old ids to the new ones"""
+    return {
+        new_population: _create_id_mapping(df.index.to_numpy())
+        for new_population, df in split_nodes.items()
+    }
+
+
+def _get_node_ids(split_nodes):
+    """return a dict split_nodes.keys() -> old ids of the nodes, in the order of the new ids
+
+    Unlike `_get_node_id_mapping`, the memory used doesn't depend on the number of populations
+    when they are split from the same node population.
+    """
     return {
-        new_population: pd.DataFrame({"new_id": np.arange(len(df), dtype=np.int64)}, index=df.index)
+        new_population: df.index.to_numpy(dtype=np.int64)
         for new_population, df in split_nodes.items()
     }
 
@@ -401,8 +663,8 @@ def split_population(output, attribute, nodes_path, edges_path):
     split_populations = _split_population_by_attribute(nodes_path, attribute)
     _write_nodes(output, split_populations)
 
-    id_mapping = _get_node_id_mapping(split_populations)
-    _write_edges(output, edges_path, id_mapping, expect_to_use_all_edges=True)
+    node_ids = _get_node_ids(split_populations)
+    _write_edges(output, edges_path, node_ids, expect_to_use_all_edges=True)
 
     _write_circuit_config(output, split_populations)
 
@@ -432,8 +694,8 @@ def simple_split_subcircuit(output, node_set_name, node_set_path, nodes_path, ed
 
     _write_nodes(output, split_populations)
 
-    id_mapping = _get_node_id_mapping(split_populations)
-    _write_edges(output, edges_path, id_mapping, expect_to_use_all_edges=False)
+    node_ids = _get_node_ids(split_populations)
+    _write_edges(output, edges_path, node_ids, expect_to_use_all_edges=False, use_indices=True)
 
 
 def _write_subcircuit_edges(
@@ -465,6 +727,7 @@ def _write_subcircuit_edges(
                 dst_edge_name=dst_edge_pop_name,
                 src_mapping=src_mapping,
                 dst_mapping=dst_mapping,
+                use_indices=True,
             )
             edge_count, sgid_count, tgid_count = _get_node_counts(h5out, dst_edge_pop_name)
 
@@ -483,6 +746,81 @@ def _write_subcircuit_edges(
         return output_path
 
 
+def _write_subcircuit_edges_worker(tasks):
+    """run the `_write_subcircuit_edges` `tasks` writing the same output file, in order
+
+    Each task is a (name, task, mapping_paths) tuple; the id mappings are memory mapped from
+    the .npy files of `mapping_paths`, so that the workers share them.
+    """
+    return [
+        (name, task(**{key: np.load(path, mmap_mode="r") for key, path in mapping_paths.items()}))
+        for name, task, mapping_paths in tasks
+    ]
+
+
+def _save_task_mappings(groups, tmp_dir):
+    """save the id mappings of the groups of `_write_subcircuit_edges` tasks to `tmp_dir`
+
+    Each id mapping is saved once to a .npy file, even if used by several tasks.
+
+    Returns:
+        list: groups of (name, task without id mappings, dict of keyword -> .npy path)
+    """
+    paths = {}
+
+    def _save(mapping):
+        if id(mapping) not in paths:
+            paths[id(mapping)] = os.path.join(tmp_dir, f"mapping_{len(paths)}.npy")
+            np.save(paths[id(mapping)], mapping)
+        return paths[id(mapping)]
+
+    ret = []
+    for group in groups:
+        ret.append([])
+        for name, task in group:
+            keywords = dict(task.keywords)
+            mapping_paths = {
+                key: _save(keywords.pop(key)) for key in ("src_mapping", "dst_mapping")
+            }
+            ret[-1].append((name, partial(task.func, *task.args, **keywords), mapping_paths))
+    return ret
+
+
+def _write_subcircuit_edges_files(tasks, max_workers=None, tmp_dir=None):
+    """run the `_write_subcircuit_edges` `tasks`, with a worker process per output file
+
+    The id mappings are passed to the workers through .npy files, written in a temporary
+    directory created in `tmp_dir`, instead of being pickled with every task.
+
+    Args:
+        tasks(dict): edge population name -> partial `_write_subcircuit_edges`
+        max_workers(int): maximum number of worker processes, DEFAULT_MAX_WORKERS if None;
+            each one reads and buffers the edges of its file, so memory grows with it
+        tmp_dir(str): directory of the temporary directory, the system default if None
+
+    Returns:
+        dict: edge population name -> path returned by `_write_subcircuit_edges`
+    """
+    groups = collections.defaultdict(list)
+    for name, task in tasks.items():
+        groups[os.path.abspath(task.keywords["output_path"])].append((name, task))
+    groups = list(groups.values())
+
+    processes = min(max_workers or DEFAULT_MAX_WORKERS, len(groups))
+    if processes <= 1:
+        results = [[(name, task()) for name, task in group] for group in groups]
+    else:
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as mappings_dir:
+            groups = _save_task_mappings(groups, mappings_dir)
+            # spawn, so that the workers don't inherit the HDF5 state of this process, which
+            # may have the edge files open
+            with multiprocessing.get_context("spawn").Pool(processes) as pool:
+                results = pool.map(_write_subcircuit_edges_worker, groups, chunksize=1)
+
+    paths = dict(it.chain.from_iterable(results))
+    return {name: paths[name] for name in tasks}
+
+
 def _gather_layout_from_networks(networks):
     """find the layout of the nodes and edges files, return a dict of the name -> relative path"""
 
@@ -532,7 +870,7 @@ def _write_subcircuit_biological(
     split_populations,
     id_mapping,
 ):
-    """write node and edge population that belong in a subcircuit
+    """write node populations that belong in a subcircuit, and prepare their edges
 
     Args:
         output: path to output
@@ -540,13 +878,14 @@ def _write_subcircuit_biological(
         node_pop_to_paths(dict): node name -> new relative path
         edge_pop_to_paths(dict): node name -> new relative path
         split_populations(dict): population -> node dataframe
-        id_mapping(dict): population name -> df with index old_ids, and colunm new_id
+        id_mapping(dict): population name -> id mapping of the old ids to the new ones
 
-    returns `new_node_files`, `new_edges_files`: the paths to node & edges files that were created
+    returns `new_node_files`, `edge_tasks`: the paths to node files that were created, and the
+    `_write_subcircuit_edges` tasks of the edge populations
     """
     new_node_files = _write_nodes(output, split_populations, node_pop_to_paths)
 
-    new_edges_files = {}
+    edge_tasks = {}
     for edge_pop_name, edge in circuit.edges.items():
         if edge.source.name in id_mapping and edge.target.name in id_mapping:
             output_path = output / edge_pop_to_paths[edge_pop_name]
@@ -558,7 +897,8 @@ def _write_subcircuit_biological(
                 edge.target.name,
                 output_path,
             )
-            new_edges_files[edge_pop_name] = _write_subcircuit_edges(
+            edge_tasks[edge_pop_name] = partial(
+                _write_subcircuit_edges,
                 output_path=str(output_path),
                 edges_path=_get_storage_path(edge),
                 src_node_pop=edge.source.name,
@@ -569,83 +909,80 @@ def _write_subcircuit_biological(
                 dst_mapping=id_mapping[edge.target.name],
             )
 
-    return new_node_files, new_edges_files
+    return new_node_files, edge_tasks
 
 
-def _get_subcircuit_external_ids(all_sgids, all_tgids, wanted_src_ids, wanted_dst_ids):
+def _get_subcircuit_external_ids(
+    all_sgids, all_tgids, wanted_src_ids, wanted_dst_ids, edge_ranges=None
+):
     """get the `external` ids
 
-    return `id_mapping` style DataFrame for connections between `all_sgids` and
-    `all_tgids` where sgids are in wanted_src_ids and tgids are in `wanted_dst_ids`
+    return an id mapping for connections between `all_sgids` and `all_tgids` where sgids
+    are in wanted_src_ids and tgids are in `wanted_dst_ids`; the new ids are given in the
+    increasing order of the sgids
 
     These are the 'external' ids that become 'virtual' in the extracted subcircuit
+
+    If `edge_ranges` is given, only these ranges of the edges are read; they must contain all
+    the edges targeting `wanted_dst_ids`. The result is the same as when reading all the edges.
     """
     h5_read_chunk_size = _h5_get_read_chunk_size()
-    ret = None
-    for sl in _create_chunked_slices(len(all_sgids), h5_read_chunk_size):
+    src_table = _create_membership_table(wanted_src_ids)
+    dst_table = _create_membership_table(wanted_dst_ids)
+    # the new ids are given once all the sgids are known, so they don't depend on the reads
+    used = np.zeros(len(src_table), dtype=bool)
+    for sl in _create_read_slices(len(all_sgids), h5_read_chunk_size, edge_ranges):
         sgids = all_sgids[sl]
         tgids = all_tgids[sl]
 
-        mask = _isin(sgids, wanted_src_ids) & _isin(tgids, wanted_dst_ids)
-
-        if mask.any():
-            needed = np.unique(sgids[mask])
-            if ret is None:
-                ret = pd.DataFrame({"new_id": np.arange(len(needed), dtype=np.uint)}, index=needed)
-            else:
-                mm = _isin(needed, ret.index.to_numpy(), invert=True)
-                if mm.any():
-                    needed = needed[mm]
-                    start_id = int(ret.new_id.max()) + 1
-                    new = pd.DataFrame(
-                        {"new_id": start_id + np.arange(len(needed), dtype=np.uint)}, index=needed
-                    )
-                    ret = pd.concat((ret, new))
-
-    if ret is None:
-        ret = pd.DataFrame({"new_id": np.array([], dtype=np.uint)}, index=[])
+        mask = _lookup_membership(src_table, sgids) & _lookup_membership(dst_table, tgids)
+        used[sgids[mask]] = True
 
-    return ret.sort_index()
+    ret = np.full(len(src_table), -1, dtype=np.int64)
+    needed = np.flatnonzero(used)
+    ret[needed] = np.arange(len(needed), dtype=np.int64)
+    return ret
 
 
 def _write_subcircuit_external(output, circuit, id_mapping):
-    """Write external connectivity.
+    """Write external connectivity nodes, and prepare their edges.
 
-    returns: (new_node_files, new_edges_files); with, respectively,
-    dictionaries with node and edge population_name -> path
+    returns: (new_node_files, edge_tasks); with, respectively, dictionaries with node
+    population_name -> path, and edge population_name -> `_write_subcircuit_edges` task
 
     Warning: this writes `id_mapping` in place
     """
+    # pylint: disable=too-many-locals
     new_nodes = {}
 
-    new_edges_files = {}
+    edge_tasks = {}
     for name, edge in circuit.edges.items():
         if edge.source.type != "virtual" and edge.target.name in id_mapping:
             wanted_src_ids = circuit.nodes[edge.source.name].ids()
 
             if edge.source.name in id_mapping:
+                used_table = id_mapping[edge.source.name] >= 0
                 wanted_src_ids = wanted_src_ids[
-                    _isin(
-                        wanted_src_ids, id_mapping[edge.source.name].index.to_numpy(), invert=True
-                    )
+                    _lookup_membership(used_table, wanted_src_ids, invert=True)
                 ]
 
             # only keep ids that are used; this is duplicating work in _copy_edge_attributes
             # but the alternative is that it keeps track of the new id_mapping; which
             # seemed less ideal
             with h5py.File(_get_storage_path(edge)) as h5:
-                all_sgids = h5[f"edges/{name}/source_node_id"]
-                all_tgids = h5[f"edges/{name}/target_node_id"]
+                orig_edges = h5[f"edges/{name}"]
+                wanted_dst_ids = _get_mapped_ids(id_mapping[edge.target.name])[0]
 
-                # overwrite wanted_src_ids with a DataFrame; the numpy array is not needed
+                # overwrite wanted_src_ids with an id mapping; the ids are not needed
                 wanted_src_ids = _get_subcircuit_external_ids(
-                    all_sgids,
-                    all_tgids,
+                    orig_edges["source_node_id"],
+                    orig_edges["target_node_id"],
                     wanted_src_ids,
-                    id_mapping[edge.target.name].index.to_numpy(),
+                    wanted_dst_ids,
+                    _get_afferent_edge_ranges(orig_edges, wanted_dst_ids),
                 )
 
-            if len(wanted_src_ids) == 0:
+            if not (wanted_src_ids >= 0).any():
                 continue
 
             new_name = f"external_{name}"
@@ -658,7 +995,8 @@ def _write_subcircuit_external(output, circuit, id_mapping):
                 edge.target.name,
                 output_path,
             )
-            new_edges_files[new_name] = _write_subcircuit_edges(
+            edge_tasks[new_name] = partial(
+                _write_subcircuit_edges,
                 output_path=str(output_path),
                 edges_path=_get_storage_path(edge),
                 src_node_pop=edge.source.name,
@@ -674,23 +1012,24 @@ def _write_subcircuit_external(output, circuit, id_mapping):
 
     new_node_files = {}
     for population_name, wanted_src_ids in new_nodes.items():
-        if len(wanted_src_ids) == 0:
-            continue
+        node_count = int(np.count_nonzero(wanted_src_ids >= 0))
         # pylint: disable=protected-access
         new_node_files[population_name] = curate._create_source_nodes(
-            population_name, len(wanted_src_ids), output
+            population_name, node_count, output
         )
 
-    return new_node_files, new_edges_files
+    return new_node_files, edge_tasks
 
 
 def _write_subcircuit_virtual(output, circuit, edge_populations_to_paths, id_mapping):
-    """write all node/edge populations that have virtual nodes as source
+    """write all node populations that have virtual nodes as source, and prepare their edges
+
+    returns: (new_node_files, edge_tasks), like `_write_subcircuit_external`
 
     Note: the id_mapping dictionary is updated with the used virtual nodes
     """
     # pylint: disable=too-many-locals
-    new_node_files, new_edges_files = {}, {}
+    new_node_files, edge_tasks = {}, {}
 
     virtual_populations = {
         name: edge
@@ -702,7 +1041,7 @@ def _write_subcircuit_virtual(output, circuit, edge_populations_to_paths, id_map
     # it's possible that a virtual population points to multiple target populations
     pop_used_source_node_ids = collections.defaultdict(list)
     for name, edge in virtual_populations.items():
-        target_node_ids = id_mapping[edge.target.name].index.to_numpy()
+        target_node_ids = _get_mapped_ids(id_mapping[edge.target.name])[0]
         target_node_ids = bluepysnap.circuit_ids.CircuitNodeIds.from_dict(
             {edge.target.name: target_node_ids}
         )
@@ -717,11 +1056,12 @@ def _write_subcircuit_virtual(output, circuit, edge_populations_to_paths, id_map
 
     # update the mappings with the virtual nodes
     for name, ids in pop_used_source_node_ids.items():
-        id_mapping[name] = pd.DataFrame({"new_id": range(len(ids))}, index=ids)
+        id_mapping[name] = _create_id_mapping(ids)
 
-    # write the edges that have the virtual populations as source
+    # prepare the edges that have the virtual populations as source
     for edge_pop_name, edge in virtual_populations.items():
-        new_edges_files[edge_pop_name] = _write_subcircuit_edges(
+        edge_tasks[edge_pop_name] = partial(
+            _write_subcircuit_edges,
             output_path=os.path.join(output, edge_populations_to_paths[edge_pop_name]),
             edges_path=_get_storage_path(edge),
             src_node_pop=edge.source.name,
@@ -739,7 +1079,7 @@ def _write_subcircuit_virtual(output, circuit, edge_populations_to_paths, id_map
         Path(nodes_path).parent.mkdir(parents=True, exist_ok=True)
         new_node_files[population_name] = _save_sonata_nodes(nodes_path, df, population_name)
 
-    return new_node_files, new_edges_files
+    return new_node_files, edge_tasks
 
 
 def _update_config_with_new_paths(output, config, new_population_files, type_):
@@ -822,13 +1162,9 @@ def _update_node_sets(node_sets, id_mapping):
             if rule["population"] not in id_mapping:
                 continue
 
-            mapping = id_mapping[rule["population"]]
+            new_ids = _map_ids(id_mapping[rule["population"]], rule["node_id"])
             ret[name] = rule
-            ret[name]["node_id"] = (
-                mapping.loc[mapping.index.intersection(rule["node_id"])]
-                .new_id.sort_values()
-                .to_list()
-            )
+            ret[name]["node_id"] = np.unique(new_ids[new_ids >= 0]).tolist()
         else:
             ret[name] = rule
 
@@ -838,17 +1174,24 @@ def _update_node_sets(node_sets, id_mapping):
 def _write_mapping(output, id_mapping):
     """write the id mappings between the old and new populations for future analysis"""
     mapping = {}
-    for population, df in id_mapping.items():
+    for population, population_mapping in id_mapping.items():
+        old_ids, new_ids = _get_mapped_ids(population_mapping)
         mapping[population] = {
-            "old_id": df.index.to_list(),
-            "new_id": df.new_id.to_list(),
+            "old_id": old_ids.tolist(),
+            "new_id": new_ids.tolist(),
         }
     utils.dump_json(output / "id_mapping.json", mapping)
 
 
-def split_subcircuit(output, node_set_name, circuit_config_path, do_virtual, create_external):
+def split_subcircuit(
+    output, node_set_name, circuit_config_path, do_virtual, create_external, max_workers=None
+):
     """Split a single subcircuit out of circuit, based on nodeset
 
+    The edge populations written to different files are extracted concurrently, by at most
+    `max_workers` processes; the config and the node sets are updated once all of them are
+    written. The memory used grows with the number of processes.
+
     Args:
         output(str): path where files will be written
         node_set_name(str): name of nodeset to extract
@@ -857,6 +1200,8 @@ def split_subcircuit(output, node_set_name, circuit_config_path, do_virtual, cre
             contained in the specified nodeset
         create_external(bool): whether to create new virtual populations of all the
             incoming connections
+        max_workers(int): maximum number of processes writing the edge files,
+            DEFAULT_MAX_WORKERS if None
     """
     # pylint: disable=too-many-locals
     output = Path(output)
@@ -882,31 +1227,33 @@ def split_subcircuit(output, node_set_name, circuit_config_path, do_virtual, cre
     # `_write_subcircuit_external`, `_write_subcircuit_virtual`
     # handle node updates and config updates?
 
-    new_node_files, new_edge_files = _write_subcircuit_biological(
+    new_node_files, edge_tasks = _write_subcircuit_biological(
         output, circuit, node_pop_to_paths, edge_pop_to_paths, split_populations, id_mapping
     )
 
     if create_external:
-        new_virtual_node_files, new_virtual_edge_files = _write_subcircuit_external(
+        new_virtual_node_files, virtual_edge_tasks = _write_subcircuit_external(
             output, circuit, id_mapping
         )
 
         new_node_files.update(new_virtual_node_files)
-        new_edge_files.update(new_virtual_edge_files)
+        edge_tasks.update(virtual_edge_tasks)
 
     if do_virtual:
-        new_virtual_node_files, new_virtual_edge_files = _write_subcircuit_virtual(
+        new_virtual_node_files, virtual_edge_tasks = _write_subcircuit_virtual(
             output, circuit, edge_pop_to_paths, id_mapping
         )
         new_node_files.update(new_virtual_node_files)
-        new_edge_files.update(new_virtual_edge_files)
+        edge_tasks.update(virtual_edge_tasks)
+
+    new_edge_files = _write_subcircuit_edges_files(edge_tasks, max_workers, tmp_dir=output)
 
     _write_mapping(output, id_mapping)
 
     config = copy.deepcopy(circuit.config)
 
     node_sets = _update_node_sets(utils.load_json(config["node_sets_file"]), id_mapping)
-    utils.dump_json(output / "node_sets.json", node_sets)
+    utils.dump_node_sets(output / "node_sets.json", node_sets)
     config["node_sets_file"] = "$BASE_DIR/node_sets.json"
 
     # update circuit_config
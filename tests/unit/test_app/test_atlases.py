@@ -0,0 +1,95 @@
+# SPDX-License-Identifier: Apache-2.0
+import nrrd
+import numpy as np
+import numpy.testing as npt
+from click.testing import CliRunner
+from voxcell import RegionMap, VoxelData
+
+from brainbuilder.app import atlases as test_module
+
+
+def _label_at_origin(mosaic, offset, voxel_side):
+    i, j = (-np.asarray(offset) / voxel_side).astype(int)
+    return mosaic[i, j]
+
+
+def test__build_2D_mosaic():
+    for width, expected_count in [(0, 1), (1, 7), (2, 19), (5, 91)]:
+        mosaic, offset = test_module._build_2D_mosaic(width, hex_side=50, voxel_side=2)
+        labels, counts = np.unique(mosaic[mosaic >= 0], return_counts=True)
+        npt.assert_array_equal(labels, np.arange(expected_count))
+        # all the columns have the same area, up to the voxelization
+        assert counts.max() - counts.min() <= 0.02 * counts.mean()
+        npt.assert_allclose(counts.mean() * 4, 1.5 * np.sqrt(3) * 50**2, rtol=0.02)
+        # no empty border
+        for axis in (0, 1):
+            filled = np.any(mosaic >= 0, axis=1 - axis)
+            assert filled[0] and filled[-1]
+
+    mosaic, offset = test_module._build_2D_mosaic(1, hex_side=50, voxel_side=5)
+    assert _label_at_origin(mosaic, offset, 5) == 2
+
+
+def test__mosaic_columns():
+    assert test_module._mosaic_columns(0) == [(0, 0)]
+    assert test_module._mosaic_columns(1) == test_module.O1_COLUMNS
+    columns = test_module._mosaic_columns(2)
+    assert len(set(columns)) == 19
+    assert all(max(abs(q), abs(r), abs(q + r)) <= 2 for q, r in columns)
+
+
+def test_column(tmp_path):
+    runner = CliRunner()
+    result = runner.invoke(
+        test_module.app,
+        ["-n", "L1,L2", "-t", "20,30", "-d", "10", "-o", str(tmp_path)]
+        + ["column", "--width", "2", "--hex-side", "40"],
+    )
+    assert result.exit_code == 0, result.output
+
+    brain_regions = VoxelData.load_nrrd(tmp_path / "brain_regions.nrrd")
+    region_map = RegionMap.load_json(tmp_path / "hierarchy.json")
+    assert len(region_map.find("O2", "acronym", with_descendants=True)) == 1 + 19 * 3
+    region_ids = np.unique(brain_regions.raw[brain_regions.raw > 0])
+    assert len(region_ids) == 19 * 2
+    assert {region_map.get(id_, "acronym") for id_ in region_ids} == {
+        f"mc{column};{layer}" for column in range(19) for layer in ("L1", "L2")
+    }
+
+
+def test__save_nrrd_by_slabs(tmp_path):
+    rng = np.random.default_rng(0)
+    for raw in [
+        np.arange(24, dtype=np.uint16).reshape((2, 3, 4)),
+        rng.random((2, 3, 4)).astype(np.float32),
+        np.broadcast_to(np.array([127, 0, 0, 0], dtype=np.int8), (2, 3, 4, 4)),
+        rng.random((2, 3, 4, 2)),
+    ]:
+        voxel_data = VoxelData(raw, voxel_dimensions=(10, 20, 30), offset=(-1, 2.5, 3))
+        if raw.ndim == 3:
+            voxel_data = voxel_data.with_data(np.asfortranarray(raw))
+        test_module._save_nrrd_by_slabs(voxel_data, tmp_path / "data.nrrd")
+
+        result = VoxelData.load_nrrd(tmp_path / "data.nrrd")
+        assert result.raw.dtype == raw.dtype
+        npt.assert_array_equal(result.raw, raw)
+        npt.assert_array_equal(result.voxel_dimensions, (10, 20, 30))
+        npt.assert_array_equal(result.offset, (-1, 2.5, 3))
+
+        # same header as `VoxelData.save_nrrd`
+        voxel_data.with_data(np.array(raw)).save_nrrd(tmp_path / "expected.nrrd")
+        header = nrrd.read_header(str(tmp_path / "data.nrrd"))
+        expected = nrrd.read_header(str(tmp_path / "expected.nrrd"))
+        assert header.keys() == expected.keys()
+        for key, value in expected.items():
+            if isinstance(value, np.ndarray):
+                npt.assert_array_equal(header[key], value)
+            else:
+                assert header[key] == value, key
+
+
+def test__build_y():
+    brain_regions = VoxelData(np.zeros((2, 3, 4), dtype=np.uint16), (10, 10, 10), (0, -10, 0))
+    result = test_module._build_y(brain_regions)
+    assert result.raw.shape == (2, 3, 4)
+    npt.assert_array_equal(result.raw[1, :, 2], [-5, 5, 15])
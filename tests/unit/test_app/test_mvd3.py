@@ -0,0 +1,46 @@
+# SPDX-License-Identifier: Apache-2.0
+import numpy as np
+import numpy.testing as npt
+from click.testing import CliRunner
+from voxcell import CellCollection, VoxelData
+
+from brainbuilder.app import mvd3 as test_module
+
+
+def _write_inputs(tmp_path):
+    cells = CellCollection()
+    cells.positions = np.array([[5.0, 5.0, 5.0], [15.0, 5.0, 5.0], [5.0, 15.0, 15.0]])
+    cells.properties["mtype"] = ["A", "B", "A"]
+    cells.save_mvd3(tmp_path / "cells.mvd3")
+    raw = np.arange(8, dtype=np.float32).reshape((2, 2, 2))
+    VoxelData(raw, voxel_dimensions=(10, 10, 10)).save_nrrd(str(tmp_path / "data.nrrd"))
+
+
+def test_add_property(tmp_path):
+    _write_inputs(tmp_path)
+    runner = CliRunner()
+
+    def _add_property(prop, output, *args):
+        return runner.invoke(
+            test_module.add_property,
+            [str(tmp_path / "cells.mvd3"), "-p", prop, "-d", str(tmp_path / "data.nrrd")]
+            + ["-o", str(output), *args],
+            catch_exceptions=False,
+        )
+
+    result = _add_property("value", tmp_path / "output.mvd3")
+    assert result.exit_code == 0
+    cells = CellCollection.load_mvd3(tmp_path / "output.mvd3")
+    npt.assert_array_equal(cells.properties["value"], [0, 4, 3])
+    assert cells.properties["mtype"].tolist() == ["A", "B", "A"]
+
+    # in place
+    result = _add_property("mtype", tmp_path / "cells.mvd3", "--no-overwrite")
+    assert result.exit_code == 0
+    cells = CellCollection.load_mvd3(tmp_path / "cells.mvd3")
+    assert cells.properties["mtype"].tolist() == ["A", "B", "A"]
+
+    result = _add_property("mtype", tmp_path / "cells.mvd3", "--overwrite")
+    assert result.exit_code == 0
+    cells = CellCollection.load_mvd3(tmp_path / "cells.mvd3")
+    npt.assert_array_equal(cells.properties["mtype"], [0, 4, 3])
@@ -1,5 +1,8 @@
 # SPDX-License-Identifier: Apache-2.0
+import h5py
 import numpy as np
+import numpy.testing as npt
+import pandas as pd
 import voxcell
 
 from brainbuilder.app import cells as test_module
@@ -55,3 +58,118 @@ def test_load_density__near_zero_values_are_ignored(tmp_path):
 
     # Sanity check for the remaining entries
     assert np.count_nonzero(result) == 18
+
+
+def _write_atlas_cells(filepath, cells_by_type):
+    """Write the cells of `cells_by_type` with the streamed atlas cells writer."""
+    with h5py.File(filepath, "w") as h5f:
+        population = h5f.create_group(f"/nodes/{test_module.ATLAS_CELLS_POPULATION}")
+        group = test_module._init_atlas_cells_group(population, np.int32)
+        for index, (positions, orientations, region_ids) in enumerate(cells_by_type.values()):
+            test_module._append_atlas_cells(group, positions, orientations, region_ids, index)
+        test_module._finalize_atlas_cells_population(population, list(cells_by_type))
+
+
+def test_atlas_cells_writer(tmp_path):
+    filepath = tmp_path / "atlas_cells.h5"
+    quaternions = np.array([[1.0, 0.0, 0.0, 0.0], [0.0, 0.0, 1.0, 0.0]])
+    _write_atlas_cells(
+        filepath,
+        {
+            "glia": (np.ones((2, 3)), quaternions, np.array([10, 11])),
+            "neuron": (np.zeros((1, 3)), quaternions[:1], np.array([12])),
+        },
+    )
+
+    cells = voxcell.CellCollection.load_sonata(filepath)
+    assert cells.population_name == test_module.ATLAS_CELLS_POPULATION
+    npt.assert_array_equal(cells.positions, [[1, 1, 1], [1, 1, 1], [0, 0, 0]])
+    npt.assert_array_equal(cells.properties["region_id"], [10, 11, 12])
+    npt.assert_array_equal(cells.properties["cell_type"], ["glia", "glia", "neuron"])
+    npt.assert_allclose(cells.orientations[0], np.identity(3))
+    with h5py.File(filepath, "r") as h5f:
+        population = h5f[f"/nodes/{test_module.ATLAS_CELLS_POPULATION}"]
+        npt.assert_array_equal(population["node_type_id"][()], [-1, -1, -1])
+        # too few cells for a library
+        assert "@library" not in population["0"]
+
+
+def test_atlas_cells_writer_matches_save_sonata(tmp_path):
+    rng = np.random.default_rng(0)
+    cells_by_type = {
+        cell_type: (
+            rng.random((count, 3)),
+            rng.random((count, 4)),
+            rng.integers(1, 100, count, dtype=np.int32),
+        )
+        for cell_type, count in [("neuron", 10), ("astrocyte", 5)]
+    }
+    _write_atlas_cells(tmp_path / "streamed.h5", cells_by_type)
+
+    # the cells as built by the former implementation, with `CellCollection.save_sonata`
+    df = pd.DataFrame(
+        np.hstack(
+            [
+                np.concatenate([positions for positions, _, _ in cells_by_type.values()]),
+                np.concatenate([orientations for _, orientations, _ in cells_by_type.values()]),
+            ]
+        ).astype(np.float32),
+        columns=["x", "y", "z", "orientation_w", "orientation_x", "orientation_y", "orientation_z"],
+    )
+    df["region_id"] = np.concatenate([region_ids for _, _, region_ids in cells_by_type.values()])
+    df["cell_type"] = pd.Categorical(
+        [cell_type for cell_type, (positions, _, _) in cells_by_type.items() for _ in positions]
+    )
+    df.index = 1 + np.arange(len(df))
+    cells = voxcell.CellCollection.from_dataframe(df)
+    cells.population_name = test_module.ATLAS_CELLS_POPULATION
+    cells.save_sonata(tmp_path / "expected.h5")
+
+    with h5py.File(tmp_path / "streamed.h5", "r") as actual, h5py.File(
+        tmp_path / "expected.h5", "r"
+    ) as expected:
+        names = []
+        expected.visititems(lambda name, obj: names.append(name))
+        actual.visititems(lambda name, obj: names.remove(name))
+        assert not names
+        prefix = f"nodes/{test_module.ATLAS_CELLS_POPULATION}"
+        for name in ["node_type_id"] + [f"0/{name}" for name in df.columns]:
+            assert actual[f"{prefix}/{name}"].dtype == expected[f"{prefix}/{name}"].dtype, name
+            npt.assert_array_equal(actual[f"{prefix}/{name}"], expected[f"{prefix}/{name}"])
+        npt.assert_array_equal(
+            actual[f"{prefix}/0/@library/cell_type"].asstr()[()],
+            expected[f"{prefix}/0/@library/cell_type"].asstr()[()],
+        )
+
+
+def test_iter_prefetched():
+    assert list(test_module._iter_prefetched(lambda x: 2 * x, [])) == []
+    assert list(test_module._iter_prefetched(lambda x: 2 * x, [1, 2, 3])) == [2, 4, 6]
+
+
+def test_prefetch_density(tmp_path):
+    filepath = tmp_path / "density.nrrd"
+    raw = np.ones((2, 2, 2), dtype=np.float32)
+    voxcell.VoxelData(raw=raw, voxel_dimensions=(25, 25, 25)).save_nrrd(filepath)
+
+    npt.assert_array_equal(test_module._prefetch_density(str(filepath)), raw)
+    # the atlas datasets are left to the calling thread
+    assert test_module._prefetch_density("{density}") == "{density}"
+    assert test_module._prefetch_density(42) == 42
+
+
+def test_read_density(tmp_path):
+    filepath = tmp_path / "density.nrrd"
+    raw = np.arange(8, dtype=np.float32).reshape((2, 2, 2))
+    voxcell.VoxelData(raw=raw, voxel_dimensions=(25, 25, 25)).save_nrrd(filepath)
+
+    result = test_module._read_density(str(filepath), atlas=None)
+    assert result.dtype == np.float64
+    npt.assert_array_equal(result, raw)
+    assert test_module._read_density(42, atlas=None) == 42
+
+    mask = np.zeros((2, 2, 2), dtype=bool)
+    mask[0] = True
+    result = test_module._load_density(result, mask, atlas=None)
+    npt.assert_array_equal(result[0], raw[0])
+    npt.assert_array_equal(result[1], 0)
@@ -2,6 +2,7 @@
 from io import StringIO
 from pathlib import Path
 
+import h5py
 import numpy as np
 import pandas as pd
 import pytest
@@ -130,6 +131,46 @@ def test_load_invalid_mecombo_emodel():
         bbp.load_mecombo_emodel(DATA_PATH / "extneuronDB.dat")
 
 
+@pytest.mark.parametrize(
+    "loader, filename",
+    [
+        (bbp.load_neurondb, "neuronDBv2.dat"),
+        (bbp.load_extneurondb, "extneuronDB.dat"),
+        (bbp.load_mecombo_emodel, "mecombo_emodel.dat"),
+    ],
+)
+def test_load_tsv_cache(monkeypatch, tmp_path, loader, filename):
+    expected = loader(DATA_PATH / filename)
+
+    monkeypatch.setenv(bbp.TSV_CACHE_DIR_ENV, str(tmp_path / "cache"))
+    assert_frame_equal(loader(DATA_PATH / filename), expected)
+    assert len(list((tmp_path / "cache").glob(f"{filename}-*.npz"))) == 1
+
+    with monkeypatch.context() as m:
+        m.setattr(pd, "read_csv", None)
+        assert_frame_equal(loader(DATA_PATH / filename), expected)
+
+    # the cache is keyed by content
+    path = tmp_path / filename
+    path.write_text((DATA_PATH / filename).read_text().replace("morph-a", "morph-c"))
+    assert loader(path).morphology.tolist() == ["morph-c", "morph-b"]
+
+
+def test_load_tsv_cache_unreadable(monkeypatch, tmp_path):
+    expected = bbp.load_neurondb(DATA_PATH / "neuronDBv2.dat")
+
+    monkeypatch.setenv(bbp.TSV_CACHE_DIR_ENV, str(tmp_path / "cache"))
+    bbp.load_neurondb(DATA_PATH / "neuronDBv2.dat")
+    (cache_path,) = (tmp_path / "cache").glob("neuronDBv2.dat-*.npz")
+    cache_path.write_bytes(b"garbage")
+    assert_frame_equal(bbp.load_neurondb(DATA_PATH / "neuronDBv2.dat"), expected)
+
+    # the cache is written again
+    with monkeypatch.context() as m:
+        m.setattr(pd, "read_csv", None)
+        assert_frame_equal(bbp.load_neurondb(DATA_PATH / "neuronDBv2.dat"), expected)
+
+
 def test_gid2str():
     actual = bbp.gid2str(42)
     assert actual == "a42"
@@ -143,6 +184,30 @@ def test_write_target():
     assert actual == expected
 
 
+def test_write_target_chunks(monkeypatch):
+    monkeypatch.setattr(bbp, "GID_CHUNK_SIZE", 2)
+    out = StringIO()
+    bbp.write_target(out, "test", gids=np.array([1, 2, 10, 42, 7]))
+    bbp.write_target(out, "empty", gids=[])
+    actual = out.getvalue()
+    expected = "\n".join(
+        [
+            "",
+            "Target Cell test",
+            "{",
+            "  a1 a2 a10 a42 a7",
+            "}",
+            "",
+            "Target Cell empty",
+            "{",
+            "  ",
+            "}",
+            "",
+        ]
+    )
+    assert actual == expected
+
+
 def test_write_property_targets():
     cells = pd.DataFrame({"prop-a": ["A", "B", "A"], "prop-b": ["X", "X", "Y"]}, index=[1, 2, 3])
     out = StringIO()
@@ -230,6 +295,32 @@ def test_assign_emodels_multiple_choice():
     assert_frame_equal(actual, expected, check_like=True)
 
 
+def test_assign_emodels_candidates():
+    np.random.seed(0)
+    cells = CellCollection()
+    cells.properties = pd.DataFrame(
+        {
+            "morphology": ["morph-A", "morph-B"] * 500,
+            "layer": 1,
+            "mtype": "mtype-A",
+            "etype": "etype-A",
+        }
+    )
+    morphdb = pd.DataFrame(
+        [
+            ("morph-B", 1, "mtype-A", "etype-A", "me_combo-B1"),
+            ("morph-A", 1, "mtype-A", "etype-A", "me_combo-A1"),
+            ("morph-A", 1, "mtype-A", "etype-A", "me_combo-A2"),
+            ("morph-B", 1, "mtype-A", "etype-A", "me_combo-B2"),
+            ("morph-A", 1, "mtype-A", "etype-A", "me_combo-A3"),
+        ],
+        columns=["morphology", "layer", "mtype", "etype", "me_combo"],
+    )
+    actual = bbp.assign_emodels(cells, morphdb).properties
+    assert (actual["me_combo"].str[:-1] == "me_combo-" + actual["morphology"].str[-1]).all()
+    assert set(actual["me_combo"]) == set(morphdb["me_combo"])
+
+
 def test_assign_emodels_overwrite():
     cells = CellCollection()
     cells.properties = pd.DataFrame(
@@ -297,3 +388,50 @@ def test_assign_emodels_subregion_fallback():
         columns=["morphology", "subregion", "mtype", "etype", "prop", "me_combo"],
     )
     assert_frame_equal(actual, expected, check_like=True)
+
+
+def test_reorder_mtypes(tmp_path):
+    cells = CellCollection()
+    cells.positions = np.zeros((5, 3))
+    cells.properties["mtype"] = ["L23_MC", "L1_DAC", "L23_PC", "L23_MC", "L1_DAC"]
+    mvd3_path = tmp_path / "circuit.mvd3"
+    cells.save_mvd3(mvd3_path)
+
+    bbp.reorder_mtypes(mvd3_path, DATA_PATH / "builderRecipeAllPathways.xml", chunk_size=2)
+
+    with h5py.File(mvd3_path, "r") as h5f:
+        assert h5f["/library/mtype"].asstr()[:4].tolist() == [
+            "L1_DAC",
+            "L23_PC",
+            "L23_MC",
+            "L23_BTC",
+        ]
+        assert h5f["/cells/properties/mtype"][:].tolist() == [2, 0, 1, 2, 0]
+    actual = CellCollection.load_mvd3(mvd3_path).properties["mtype"]
+    assert actual.tolist() == ["L23_MC", "L1_DAC", "L23_PC", "L23_MC", "L1_DAC"]
+
+
+def test_merge_mvd3(tmp_path):
+    paths = []
+    for i, (mtypes, layers) in enumerate([(["A", "C", "A"], [1, 2, 3]), (["B", "A"], [4, 5])]):
+        cells = CellCollection()
+        cells.positions = np.random.random((len(mtypes), 3))
+        cells.orientations = np.tile(np.identity(3), (len(mtypes), 1, 1))
+        cells.properties["mtype"] = mtypes
+        cells.properties["layer"] = np.array(layers, dtype=np.int32)
+        paths.append(tmp_path / f"cells{i}.mvd3")
+        cells.save_mvd3(paths[-1])
+
+    bbp.merge_mvd3(paths, tmp_path / "merged.mvd3", chunk_size=2)
+
+    expected = pd.concat([CellCollection.load_mvd3(p).as_dataframe() for p in paths])
+    actual = CellCollection.load_mvd3(tmp_path / "merged.mvd3").as_dataframe()
+    assert_frame_equal(actual, expected.set_index(actual.index), check_like=True)
+    with h5py.File(tmp_path / "merged.mvd3", "r") as h5f:
+        assert h5f["library/mtype"].asstr()[:].tolist() == ["A", "B", "C"]
+        assert h5f["cells/properties/layer"].dtype == np.int32
+
+    cells.properties["etype"] = "E"
+    cells.save_mvd3(paths[-1])
+    with pytest.raises(BrainBuilderError, match="different properties"):
+        bbp.merge_mvd3(paths, tmp_path / "merged.mvd3")
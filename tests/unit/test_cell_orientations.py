@@ -1,8 +1,10 @@
 # SPDX-License-Identifier: Apache-2.0
 import numpy as np
 import numpy.testing as npt
+import pytest
 
 import brainbuilder.cell_orientations as test_module
+from brainbuilder.utils.random import sample_distr
 
 
 def test_apply_rotation_1():
@@ -41,3 +43,38 @@ def test_apply_random_rotation():
     A = np.random.random((2, 3, 3))
     A2 = test_module.apply_random_rotation(A, "x", distr=("uniform", {"low": 0, "high": np.pi}))
     assert A2.shape == A.shape
+
+
+def test_apply_random_rotations():
+    rotations = [
+        ("x", ("uniform", {"low": -np.pi, "high": np.pi})),
+        ("z", ("norm", {"mean": 0.0, "sd": 1.0})),
+    ]
+    A = test_module._quaternions_to_matrices(np.random.normal(size=(10, 4)))
+
+    np.random.seed(42)
+    expected = A
+    for axis, distr in rotations:
+        angles = sample_distr(distr, len(A))
+        expected = test_module.apply_rotation(expected, angles, axis)
+
+    np.random.seed(42)
+    result = test_module.apply_random_rotations(A, rotations, chunk_size=3)
+    npt.assert_allclose(result, expected, atol=1e-12)
+
+    quaternions = test_module.apply_random_rotations(
+        test_module._matrices_to_quaternions(A),
+        rotations,
+        output="quaternions",
+        rng=np.random.RandomState(42),
+    )
+    assert quaternions.shape == (10, 4)
+    npt.assert_allclose(test_module._quaternions_to_matrices(quaternions), expected, atol=1e-12)
+
+
+def test_apply_random_rotations_raises():
+    A = np.tile(np.identity(3), (2, 1, 1))
+    with pytest.raises(ValueError, match="Unknown axis"):
+        test_module.apply_random_rotations(A, [("w", ("uniform", {"low": 0, "high": 1}))])
+    with pytest.raises(ValueError, match="Unknown output format"):
+        test_module.apply_random_rotations(A, [], output="eulers")
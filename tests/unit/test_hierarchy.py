@@ -0,0 +1,65 @@
+# SPDX-License-Identifier: Apache-2.0
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pytest
+import voxcell
+
+from brainbuilder.hierarchy import HierarchyIndex
+
+HIERARCHY = {
+    "id": 997,
+    "acronym": "root",
+    "name": "root",
+    "children": [
+        {
+            "id": 8,
+            "acronym": "grey",
+            "name": "grey",
+            "children": [
+                {"id": 68, "acronym": "FRP1", "name": "FRP1", "children": []},
+                {"id": 667, "acronym": "FRP2/3", "name": "FRP2/3", "children": []},
+            ],
+        },
+        {"id": 1009, "acronym": "fiber tracts", "name": "fiber tracts", "children": []},
+    ],
+}
+
+
+def test_hierarchy_index():
+    index = HierarchyIndex.from_region_map(voxcell.RegionMap.from_dict(HIERARCHY))
+    acronyms = ["root", "grey", "FRP1", "FRP2/3", "fiber tracts"]
+    pos = dict(zip(acronyms, index.positions(acronyms)))
+
+    assert index.acronyms[pos["grey"]] == "grey"
+    assert index.ids[pos["grey"]] == 8
+    assert index.parents[pos["root"]] == -1
+    assert index.parents[pos["FRP1"]] == pos["grey"]
+    npt.assert_array_equal(index.depths[index.positions(acronyms)], [0, 1, 2, 2, 1])
+
+    def _acronyms(positions):
+        return sorted(index.acronyms[positions])
+
+    assert _acronyms(index.descendants(index.positions(["grey"]))) == ["FRP1", "FRP2/3", "grey"]
+    assert _acronyms(index.descendants(index.positions(["FRP1", "fiber tracts", "FRP1"]))) == [
+        "FRP1",
+        "fiber tracts",
+    ]
+    assert _acronyms(index.descendants(index.positions(["root", "grey"]))) == sorted(acronyms)
+    assert _acronyms(index.ancestors(index.positions(["FRP1"]))) == ["FRP1", "grey", "root"]
+    assert _acronyms(index.ancestors(index.positions(["FRP1", "fiber tracts"]))) == [
+        "FRP1",
+        "fiber tracts",
+        "grey",
+        "root",
+    ]
+    assert len(index.ancestors(np.array([], dtype=int))) == 0
+
+
+def test_hierarchy_index_raises():
+    region_map_df = pd.DataFrame(
+        {"acronym": ["a", "b"], "parent_id": [2, 1]},
+        index=pd.Index([1, 2], name="id"),
+    )
+    with pytest.raises(ValueError, match="cycles"):
+        HierarchyIndex(region_map_df)
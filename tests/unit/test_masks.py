@@ -0,0 +1,55 @@
+# SPDX-License-Identifier: Apache-2.0
+import numpy as np
+import numpy.testing as npt
+
+import brainbuilder.masks as test_module
+
+
+def test_triangular_mask():
+    expected = np.array(
+        [
+            [1, 1, 1, 1, 1],
+            [1, 1, 1, 1, 0],
+            [1, 1, 1, 0, 0],
+            [1, 1, 0, 0, 0],
+            [1, 0, 0, 0, 0],
+        ],
+        dtype=bool,
+    )
+    npt.assert_array_equal(test_module.triangular_mask((5, 5), [0, 0], [4, 0], [0, 4]), expected)
+    # the orientation of the vertices does not matter
+    npt.assert_array_equal(test_module.triangular_mask((5, 5), [0, 0], [0, 4], [4, 0]), expected)
+
+
+def test_triangular_mask_degenerate():
+    result = test_module.triangular_mask((5, 5), [1, 0], [1, 2], [1, 1])
+    expected = np.zeros((5, 5), dtype=bool)
+    expected[1, :3] = True
+    npt.assert_array_equal(result, expected)
+
+
+def test_convex_polygon_mask():
+    result = test_module.convex_polygon_mask((5, 6), [[1, 1], [1, 4], [3, 4], [3, 1]])
+    expected = np.zeros((5, 6), dtype=bool)
+    expected[1:4, 1:5] = True
+    npt.assert_array_equal(result, expected)
+
+
+def test_regular_convex_polygon_mask_from_side():
+    result = test_module.regular_convex_polygon_mask_from_side(10, 6, 2)
+    expected = np.array(
+        [
+            [0, 0, 0, 0, 1, 1, 0, 0, 0, 0],
+            [0, 0, 1, 1, 1, 1, 1, 1, 0, 0],
+            [0, 1, 1, 1, 1, 1, 1, 1, 1, 0],
+            [0, 1, 1, 1, 1, 1, 1, 1, 1, 0],
+            [0, 1, 1, 1, 1, 1, 1, 1, 1, 0],
+            [0, 1, 1, 1, 1, 1, 1, 1, 1, 0],
+            [0, 1, 1, 1, 1, 1, 1, 1, 1, 0],
+            [0, 1, 1, 1, 1, 1, 1, 1, 1, 0],
+            [0, 0, 1, 1, 1, 1, 1, 1, 0, 0],
+            [0, 0, 0, 0, 1, 1, 0, 0, 0, 0],
+        ],
+        dtype=bool,
+    )
+    npt.assert_array_equal(result, expected)
@@ -1,4 +1,6 @@
 # SPDX-License-Identifier: Apache-2.0
+import numpy as np
+import numpy.testing as npt
 import pytest
 
 import brainbuilder.utils.random as test_module
@@ -32,3 +34,43 @@ def test_parse_distr_raises():
         test_module.parse_distr(("norm", {"loc": 2}))
     with pytest.raises(AttributeError):
         test_module.parse_distr(("foo", None))
+
+
+def test_parse_distr_cached():
+    distr = test_module.parse_distr(("norm", {"mean": 1, "sd": 2}))
+    assert test_module.parse_distr(("norm", {"mean": 1, "sd": 2})) is distr
+    assert test_module.parse_distr(("normal", {"sd": 2, "loc": 1})).kwds == distr.kwds
+    assert test_module.parse_distr('["norm", {"loc": 1, "scale": 2}]').kwds == distr.kwds
+    assert test_module.parse_distr(("norm", {"mean": np.float32(1), "sd": 2})) is distr
+    # not hashable, not cached
+    assert test_module.parse_distr(("norm", {"mean": 1, "sd": np.array(2)})).kwds == distr.kwds
+    assert test_module.parse_distr(("norm", {"mean": 1, "sd": 3})).kwds != distr.kwds
+
+
+def test_parse_distr_numpy_scalars():
+    distr = test_module.parse_distr(("uniform", {"low": np.int64(0), "high": 2}))
+    assert distr.support() == (0, 2)
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        ("norm", {"mean": 1, "sd": 2}),
+        ("truncnorm", {"mean": 1, "sd": 2, "a": -1, "b": 0.5}),
+        ("truncnorm", {"mean": 1, "sd": 2, "a": 3, "b": 5}),
+        ("uniform", {"a": 2, "b": 1}),
+        ("gamma", {"a": 2}),
+    ],
+)
+def test_sample_distr(value):
+    distr = test_module.parse_distr(value)
+    samples = test_module.sample_distr(value, 10000, np.random.default_rng(0))
+    assert samples.shape == (10000,)
+    assert np.all((samples >= distr.support()[0]) & (samples <= distr.support()[1]))
+    npt.assert_allclose(samples.mean(), distr.mean(), atol=0.1)
+    npt.assert_allclose(samples.std(), distr.std(), rtol=0.05)
+
+    npt.assert_array_equal(
+        test_module.sample_distr(value, 10, np.random.default_rng(1)),
+        test_module.sample_distr(value, 10, np.random.default_rng(1)),
+    )
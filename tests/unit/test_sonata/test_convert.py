@@ -3,6 +3,7 @@ import importlib
 from unittest.mock import Mock
 
 import numpy as np
+import numpy.testing as npt
 import pandas as pd
 import pytest
 import voxcell
@@ -117,6 +118,36 @@ def test_write_node_set_from_targets(tmp_path):
     assert all("node_id" not in data[k] for k in keys_without_node_ids)
 
 
+@pytest.mark.parametrize("read_size", [3, 1 << 20])
+def test__parse_targets(monkeypatch, read_size):
+    monkeypatch.setattr(convert, "TARGET_READ_SIZE", read_size)
+    target_files = [str(TEST_DATA_PATH / "start.target"), str(TEST_DATA_PATH / "user.target")]
+    targets = convert._parse_targets(target_files)
+
+    gids, include_targets = targets["All"]
+    assert len(gids) == 0
+    assert include_targets == ["L1_DLAC", "L23_PC", "L4_NBC", "L5_TTPC1", "L6_LBC"]
+
+    gids, include_targets = targets["Inhibitory"]
+    assert gids.dtype == np.int64
+    npt.assert_array_equal(gids, [1, 3, 5])
+    assert include_targets == []
+
+    assert targets["User:target"][1] == ["All"]
+
+    with pytest.raises(BrainBuilderError, match="duplicated"):
+        convert._parse_targets(target_files + target_files[:1])
+
+
+def test__parse_targets_one_line(tmp_path):
+    path = tmp_path / "one_line.target"
+    path.write_text("Target Cell A{a1 a22 a3}Target Cell B {\n A a4\n}\n")
+    targets = convert._parse_targets([path])
+    npt.assert_array_equal(targets["A"][0], [1, 22, 3])
+    npt.assert_array_equal(targets["B"][0], [4])
+    assert targets["B"][1] == ["A"]
+
+
 def test_validate_node_set():
     fake_set = {
         "All": ["fake1", "fake2"],
@@ -144,3 +175,30 @@ def test_validate_node_set():
 
     with pytest.raises(BrainBuilderError):
         convert.validate_node_set(incorrect_set, cells)
+
+
+def test_validate_node_set_resolves_once():
+    node_set = {
+        "A": {"node_id": [2, 0, 1]},
+        "B": {"mtype": "B"},
+        "AB": ["A", "B"],
+        "ABB": ["AB", "B"],
+        "Empty": [],
+    }
+    ids = {"A": [1, 2, 3], "B": [5, 4], "AB": [1, 2, 3, 4, 5], "ABB": [5, 4, 3, 2, 1], "Empty": []}
+    queries = []
+
+    def fake_ids(target):
+        if isinstance(target, dict):
+            queries.append(target)
+            return [4, 5, 5]
+        return ids[target]
+
+    cells = Mock()
+    cells.ids = fake_ids
+    convert.validate_node_set(node_set, cells)
+    assert queries == [{"mtype": "B"}]
+
+    ids["ABB"] = [1, 2, 3, 4]
+    with pytest.raises(BrainBuilderError, match="Target ABB differs"):
+        convert.validate_node_set(node_set, cells)
@@ -1,4 +1,5 @@
 # SPDX-License-Identifier: Apache-2.0
+from functools import partial
 from pathlib import Path
 
 import h5py
@@ -68,8 +69,38 @@ def test__get_node_id_mapping():
     }
     ret = split_population._get_node_id_mapping(split_nodes)
     assert len(ret) == 2
-    assert ret["A"].new_id.to_list() == list(range(10))
-    assert ret["B"].new_id.to_list() == list(range(5))
+    assert_array_equal(ret["A"], np.arange(10))
+    assert_array_equal(ret["B"], np.r_[np.full(10, -1), np.arange(5)])
+
+
+def test__get_node_groups():
+    node_ids = split_population._get_node_ids(
+        {
+            "A": pd.DataFrame(index=[5, 1]),
+            "B": pd.DataFrame(index=[0, 3]),
+        }
+    )
+    groups, new_ids = split_population._get_node_groups(node_ids)
+    assert_array_equal(groups, [1, 0, -1, 1, -1, 0])
+    assert_array_equal(new_ids, [0, 1, -1, 1, -1, 0])
+
+    with pytest.raises(AssertionError, match="must be disjoint"):
+        split_population._get_node_groups({"A": np.array([1, 2]), "B": np.array([2])})
+
+
+def test__id_mapping():
+    id_mapping = split_population._create_id_mapping([5, 1, 3])
+    assert_array_equal(id_mapping, [-1, 1, -1, 2, -1, 0])
+
+    ids = np.array([0, 1, 3, 5, 6, 100], dtype=np.uint64)
+    assert_array_equal(split_population._map_ids(id_mapping, ids), [-1, 1, 2, 0, -1, -1])
+
+    old_ids, new_ids = split_population._get_mapped_ids(id_mapping)
+    assert_array_equal(old_ids, [1, 3, 5])
+    assert_array_equal(new_ids, [1, 2, 0])
+
+    id_mapping = split_population._create_id_mapping([])
+    assert_array_equal(split_population._map_ids(id_mapping, ids), np.full(6, -1))
 
 
 def test__split_population_by_attribute():
@@ -110,13 +141,13 @@ def test__write_circuit_config(tmp_path):
 
 
 @pytest.mark.parametrize(
-    "id_mapping, h5_read_chunk_size, expected_dir",
+    "node_ids, h5_read_chunk_size, expected_dir",
     [
         (
             {
                 # edges: A -> B (2), B -> A, B -> B
-                "A": pd.DataFrame({"new_id": np.arange(4)}, index=[5, 4, 3, 0]),
-                "B": pd.DataFrame({"new_id": np.arange(2)}, index=[1, 2]),
+                "A": np.array([5, 4, 3, 0]),
+                "B": np.array([1, 2]),
             },
             10,
             DATA_PATH / "01",
@@ -124,8 +155,8 @@ def test__write_circuit_config(tmp_path):
         (
             {
                 # edges: A -> A (4)
-                "A": pd.DataFrame({"new_id": np.arange(4)}, index=[3, 2, 1, 0]),
-                "B": pd.DataFrame({"new_id": np.arange(2)}, index=[5, 4]),
+                "A": np.array([3, 2, 1, 0]),
+                "B": np.array([5, 4]),
             },
             10,
             DATA_PATH / "02",
@@ -133,8 +164,8 @@ def test__write_circuit_config(tmp_path):
         (
             {
                 # edges: B -> B (4), reduced chunk size
-                "A": pd.DataFrame({"new_id": np.arange(3)}, index=[5, 4, 3]),
-                "B": pd.DataFrame({"new_id": np.arange(3)}, index=[2, 1, 0]),
+                "A": np.array([5, 4, 3]),
+                "B": np.array([2, 1, 0]),
             },
             3,
             DATA_PATH / "03",
@@ -142,8 +173,8 @@ def test__write_circuit_config(tmp_path):
         (
             {
                 # edges: A -> A, A -> B (3)
-                "A": pd.DataFrame({"new_id": np.arange(4)}, index=[2, 0, 4, 5]),
-                "B": pd.DataFrame({"new_id": np.arange(2)}, index=[1, 3]),
+                "A": np.array([2, 0, 4, 5]),
+                "B": np.array([1, 3]),
             },
             10,
             DATA_PATH / "04",
@@ -151,30 +182,64 @@ def test__write_circuit_config(tmp_path):
         (
             {
                 # edges: B -> B, B -> A (3)
-                "A": pd.DataFrame({"new_id": np.arange(4)}, index=[1, 3, 4, 5]),
-                "B": pd.DataFrame({"new_id": np.arange(2)}, index=[2, 0]),
+                "A": np.array([1, 3, 4, 5]),
+                "B": np.array([2, 0]),
             },
             10,
             DATA_PATH / "05",
         ),
     ],
 )
-def test__write_edges(tmp_path, id_mapping, h5_read_chunk_size, expected_dir):
+def test__write_edges(tmp_path, node_ids, h5_read_chunk_size, expected_dir):
     # edges.h5 contains the following edges:
     # '/edges/default/source_node_id': [2, 0, 0, 2]
     # '/edges/default/target_node_id': [0, 1, 1, 1]
     edges_path = DATA_PATH / "edges.h5"
-    # iterate over different id_mappings to split the edges in different ways
+    # iterate over different node_ids to split the edges in different ways
     split_population._write_edges(
         tmp_path,
         edges_path,
-        id_mapping,
+        node_ids,
         expect_to_use_all_edges=True,
         h5_read_chunk_size=h5_read_chunk_size,
     )
     utils.assert_h5_dirs_equal(tmp_path, expected_dir, pattern="edges_*.h5")
 
 
+def test__write_edges_batches(tmp_path, monkeypatch):
+    # a single target population at once
+    monkeypatch.setattr(split_population, "MAX_OPEN_EDGE_FILES", 1)
+    node_ids = {
+        # edges: A -> B (2), B -> A, B -> B
+        "A": np.array([5, 4, 3, 0]),
+        "B": np.array([1, 2]),
+    }
+    for use_indices in (False, True):
+        split_population._write_edges(
+            tmp_path, DATA_PATH / "edges.h5", node_ids, use_indices=use_indices
+        )
+        utils.assert_h5_dirs_equal(tmp_path, DATA_PATH / "01", pattern="edges_*.h5")
+
+
+def test__get_edge_selections():
+    src_groups = np.array([0, 1, -1, 1, 0, 1])
+    dst_groups = np.array([1, 1, 0, 1, 1, -1])
+    ret = split_population._get_edge_selections(src_groups, dst_groups, group_count=2)
+    assert list(ret) == [(0, 1), (1, 1)]
+    assert_array_equal(ret[(0, 1)], [0, 4])
+    assert_array_equal(ret[(1, 1)], [1, 3])
+
+
+def test__write_edges_removes_stale_files(tmp_path):
+    node_ids = {
+        "A": np.array([3, 2, 1, 0]),
+        "B": np.array([5, 4]),
+    }
+    (tmp_path / "edges_B.h5").touch()
+    split_population._write_edges(tmp_path, DATA_PATH / "edges.h5", node_ids)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["edges_A.h5"]
+
+
 def test_split_population(tmp_path):
     attribute = "mtype"
     nodes_path = DATA_PATH / "nodes.h5"
@@ -352,7 +417,7 @@ def test__update_node_sets():
         },
     }
     id_mapping = {
-        "A": pd.DataFrame({"new_id": np.arange(4)}, index=[0, 5, 4, 3]),
+        "A": split_population._create_id_mapping([0, 5, 4, 3]),
     }
     ret = split_population._update_node_sets(node_sets, id_mapping)
 
@@ -379,18 +444,34 @@ def test_get_subcircuit_external_ids(monkeypatch):
 
     wanted_src_ids = [10, 12]
     wanted_dst_ids = [10]
-    expected = pd.DataFrame({"new_id": np.array([0, 1], np.uint)}, index=[10, 12])
-    pd.testing.assert_frame_equal(expected, get_ids(wanted_src_ids, wanted_dst_ids))
+    expected = np.r_[np.full(10, -1), 0, -1, 1]
+    assert_array_equal(expected, get_ids(wanted_src_ids, wanted_dst_ids))
 
     wanted_src_ids = [10]
     wanted_dst_ids = [10, 12, 11]
-    expected = pd.DataFrame({"new_id": np.array([0], np.uint)}, index=[10])
-    pd.testing.assert_frame_equal(expected, get_ids(wanted_src_ids, wanted_dst_ids))
+    expected = np.r_[np.full(10, -1), 0]
+    assert_array_equal(expected, get_ids(wanted_src_ids, wanted_dst_ids))
 
     wanted_src_ids = [10, 12, 11]
     wanted_dst_ids = [10, 12]
-    expected = pd.DataFrame({"new_id": np.array([0, 1, 2], np.uint)}, index=[10, 11, 12])
-    pd.testing.assert_frame_equal(expected, get_ids(wanted_src_ids, wanted_dst_ids))
+    expected = np.r_[np.full(10, -1), 0, 1, 2]
+    assert_array_equal(expected, get_ids(wanted_src_ids, wanted_dst_ids))
+
+
+def test_get_subcircuit_external_ids_edge_ranges(monkeypatch):
+    monkeypatch.setenv("H5_READ_CHUNKSIZE", "2")
+    # the full scan and the edge ranges read the edges by different chunks
+    all_sgids = np.array([11, 12, 10, 10])
+    all_tgids = np.array([0, 2, 2, 0])
+    full = split_population._get_subcircuit_external_ids(all_sgids, all_tgids, [10, 11, 12], [2])
+    assert_array_equal(full, np.r_[np.full(10, -1), 0, -1, 1])
+    for edge_ranges in [[(1, 3)], [(1, 2), (2, 3)]]:
+        assert_array_equal(
+            full,
+            split_population._get_subcircuit_external_ids(
+                all_sgids, all_tgids, [10, 11, 12], [2], edge_ranges=edge_ranges
+            ),
+        )
 
 
 def _find_populations_by_path(networks, key, name):
@@ -602,3 +683,85 @@ def test_split_subcircuit_with_virtual(tmp_path):
         networks, "edges", "$BASE_DIR/V2__C/virtual_edges_V2.h5"
     )
     assert virtual_pop == {"V2__C": {"type": "chemical"}}
+
+
+def test__create_read_slices(monkeypatch):
+    ret = list(split_population._create_read_slices(10, 4))
+    assert ret == [slice(0, 4), slice(4, 8), slice(8, 12)]
+
+    monkeypatch.setattr(split_population, "EDGE_RANGES_MAX_GAP", 2)
+    ret = list(split_population._create_read_slices(100, 4, [(0, 1), (3, 5), (20, 30), (40, 41)]))
+    assert ret == [
+        slice(0, 4),
+        slice(4, 5),
+        slice(20, 24),
+        slice(24, 28),
+        slice(28, 30),
+        slice(40, 41),
+    ]
+
+    assert not list(split_population._create_read_slices(100, 4, []))
+
+
+def test__get_afferent_edge_ranges(tmp_path):
+    edges_path = DATA_PATH / "split_subcircuit" / "networks" / "edges" / "edges.h5"
+    with h5py.File(edges_path, "r") as h5:
+        orig_edges = h5["edges/A__B"]
+        ranges = split_population._get_afferent_edge_ranges(orig_edges, [2, 0])
+        assert ranges == [(0, 1), (2, 4)]
+        assert_array_equal(orig_edges["target_node_id"][:], [0, 5, 0, 2])
+
+    with h5py.File(tmp_path / "edges.h5", "w") as h5:
+        h5.create_dataset("edges/default/source_node_id", data=[0])
+        assert split_population._get_afferent_edge_ranges(h5["edges/default"], [0]) is None
+
+
+def test__lookup_membership():
+    table = split_population._create_membership_table([5, 1, 3])
+    assert_array_equal(table, [False, True, False, True, False, True])
+
+    ids = np.array([0, 1, 3, 5, 6, 100], dtype=np.uint64)
+    assert_array_equal(
+        split_population._lookup_membership(table, ids), [False, True, True, True, False, False]
+    )
+    assert_array_equal(
+        split_population._lookup_membership(table, ids, invert=True),
+        [True, False, False, False, True, True],
+    )
+
+    table = split_population._create_membership_table([])
+    assert_array_equal(split_population._lookup_membership(table, ids), np.zeros(6, dtype=bool))
+
+
+def test__save_task_mappings(tmp_path):
+    shared, other = np.array([1, -1, 0]), np.array([0])
+    groups = [
+        [("a", partial(dict, output_path="a.h5", src_mapping=shared, dst_mapping=shared))],
+        [("b", partial(dict, output_path="b.h5", src_mapping=other, dst_mapping=shared))],
+    ]
+    ret = split_population._save_task_mappings(groups, tmp_path)
+    assert len(list(tmp_path.glob("*.npy"))) == 2
+    ((name, task, mapping_paths),) = ret[1]
+    assert name == "b"
+    assert task() == {"output_path": "b.h5"}
+    assert_array_equal(np.load(mapping_paths["src_mapping"]), other)
+    assert_array_equal(np.load(mapping_paths["dst_mapping"]), shared)
+
+
+def test_split_subcircuit_with_workers(tmp_path):
+    node_set_name = "mtype_a"
+    circuit_config_path = str(DATA_PATH / "split_subcircuit" / "circuit_config.json")
+    for max_workers in (1, 2):
+        split_population.split_subcircuit(
+            tmp_path / str(max_workers),
+            node_set_name,
+            circuit_config_path,
+            do_virtual=True,
+            create_external=True,
+            max_workers=max_workers,
+        )
+
+    assert load_json(tmp_path / "1" / "circuit_config.json") == load_json(
+        tmp_path / "2" / "circuit_config.json"
+    )
+    utils.assert_h5_dirs_equal(tmp_path / "2", tmp_path / "1", pattern="**/*.h5")
@@ -1,12 +1,17 @@
 # SPDX-License-Identifier: Apache-2.0
+import time
+import weakref
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
+import pytest
 import voxcell
 from voxcell.nexus.voxelbrain import Atlas
 
 import brainbuilder.targets as tested
+from brainbuilder.exceptions import BrainBuilderError
+from brainbuilder.hierarchy import HierarchyIndex
 
 TEST_DATA_PATH = Path(__file__).parent.parent / "unit/data"
 
@@ -28,7 +33,7 @@ def test__add_occupied_hierarchy():
 
     occupied_regions = {"FRP1", "FRP2/3", "CTXpl"}
     result = {"CTXpl": {"region": "CTXpl"}}
-    tested._add_occupied_hierarchy(region_map_df, occupied_regions, result)
+    tested._add_occupied_hierarchy(HierarchyIndex(region_map_df), occupied_regions, result)
     expected = {
         "FRP": ["FRP1", "FRP2/3"],
         "Isocortex": ["FRP"],
@@ -142,3 +147,87 @@ def test_create_node_sets():
         },
     }
     assert res == expected
+
+
+def test__occupied_values():
+    cells = pd.DataFrame(
+        {
+            "mtype": pd.Categorical(["L2_X", "L6_Y", "L6_Y", None]),
+            "layer": [2, 6, 5, 5],
+        }
+    )
+    assert tested._occupied_values(cells, ("mtype",)) == {("L2_X",), ("L6_Y",)}
+    assert tested._occupied_values(cells, ("layer", "mtype")) == {
+        (2, "L2_X"),
+        (6, "L6_Y"),
+        (5, "L6_Y"),
+    }
+
+
+def test_create_node_sets_empty():
+    cells = voxcell.CellCollection.load(TEST_DATA_PATH / "target_nodes.h5")
+    cells.properties["synapse_class"] = ["EXC", "INH", "EXC"]
+
+    res = tested.create_node_sets(cells, False, None, None, False, "default")
+    assert res["Excitatory"] == {"synapse_class": "EXC"}
+
+    cells.properties["synapse_class"] = "EXC"
+    with pytest.raises(BrainBuilderError, match="Empty target: Inhibitory"):
+        tested.create_node_sets(cells, False, None, None, False, "default")
+
+    # the regex query of the targets file selects no cell
+    cells.properties["synapse_class"] = ["EXC", "INH", "EXC"]
+    with pytest.raises(BrainBuilderError, match="Empty target: L3_MC"):
+        tested.create_node_sets(
+            cells, False, None, TEST_DATA_PATH / "targets.yaml", False, "default"
+        )
+
+
+def test_lookup_atlas_masks():
+    raw = np.random.default_rng(0).integers(0, 2, size=(4, 5, 6), dtype=np.uint8)
+    masks = {
+        ("data", "{a}", voxcell.ROIMask): voxcell.ROIMask(raw=raw, voxel_dimensions=(10, 10, 10)),
+        ("data", "{b}", voxcell.ROIMask): voxcell.ROIMask(
+            raw=1 - raw, voxel_dimensions=(10, 10, 10)
+        ),
+        ("data", "{c}", voxcell.ROIMask): voxcell.ROIMask(
+            raw=raw[::2, ::2, ::2], voxel_dimensions=(20, 20, 20), offset=(5, 5, 5)
+        ),
+    }
+    atlas = MockAtlas({"id": 0, "acronym": "a", "name": "a"}, masks)
+    positions = np.random.default_rng(1).uniform(5, 40, size=(100, 3))
+    res = tested.lookup_atlas_masks(atlas, {"A": "{a}", "B": "{b}", "C": "{c}"}, positions)
+
+    assert list(res) == ["A", "B", "C"]
+    for name, (_, dset, _) in zip(res, masks):
+        np.testing.assert_array_equal(
+            res[name], atlas.load_data(dset, cls=voxcell.ROIMask).lookup(positions)
+        )
+
+
+def test_lookup_atlas_masks_bounded(monkeypatch):
+    monkeypatch.setattr(tested, "MASK_LOADING_WORKERS", 2)
+    raw = np.ones((2, 2, 2), dtype=np.uint8)
+    loaded = []
+    alive = weakref.WeakSet()
+
+    class SlowMask(voxcell.ROIMask):
+        def positions_to_indices(self, positions, **kwargs):
+            time.sleep(0.05)
+            return super().positions_to_indices(positions, **kwargs)
+
+    class CountingAtlas(MockAtlas):
+        def load_data(self, data_type, cls=voxcell.VoxelData, memcache=False):
+            # a different grid for each mask, so that each lookup is slow
+            mask = SlowMask(raw=raw, voxel_dimensions=(10, 10, 10), offset=(-len(loaded), 0, 0))
+            alive.add(mask)
+            loaded.append((data_type, len(alive)))
+            return mask
+
+    atlas = CountingAtlas({"id": 0, "acronym": "a", "name": "a"}, {})
+    atlas_based = {f"T{i}": f"{{m{i}}}" for i in range(5)}
+    masks = tested.lookup_atlas_masks(atlas, atlas_based, np.array([[5.0, 5.0, 5.0]]))
+    assert list(masks) == list(atlas_based)
+    assert sorted(dset for dset, _ in loaded) == sorted(atlas_based.values())
+    # the masks loaded ahead, and the one being looked up
+    assert max(count for _, count in loaded) <= 3
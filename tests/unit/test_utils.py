@@ -0,0 +1,64 @@
+# SPDX-License-Identifier: Apache-2.0
+import h5py
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from brainbuilder import utils as test_module
+
+
+def test_dump_node_sets(tmp_path):
+    node_sets = {
+        "All": {"population": "default"},
+        "Layer1": ["L1_X", "L1_Y"],
+        "cylinder": {"population": "default", "node_id": [0, 1, 2]},
+        "empty": {"population": "default", "node_id": []},
+    }
+    path = tmp_path / "node_sets.json"
+    test_module.dump_node_sets(path, node_sets)
+    assert test_module.load_json(path) == node_sets
+    assert '"node_id": [0,1,2]\n' in path.read_text()
+
+
+def test_get_dataset_chunksize():
+    assert test_module.get_dataset_chunksize(np.float64) == test_module.DATASET_CHUNKSIZE
+    assert (
+        test_module.get_dataset_chunksize(np.float64, expected_size=10**9)
+        == test_module.DATASET_CHUNK_BYTES // 8
+    )
+    assert test_module.get_dataset_chunksize(np.uint8, expected_size=10) == 10
+    assert test_module.get_dataset_chunksize(np.uint8, expected_size=0) == 1
+
+
+def test_create_appendable_dataset_small(tmp_path):
+    path = tmp_path / "test.h5"
+    with h5py.File(path, "w") as h5:
+        for i in range(20):
+            test_module.create_appendable_dataset(h5, f"dset_{i}", np.float64)
+            test_module.append_to_dataset(h5[f"dset_{i}"], np.arange(10))
+    # one chunk of DATASET_CHUNKSIZE values per dataset, plus the metadata
+    assert path.stat().st_size < 20 * (test_module.DATASET_CHUNKSIZE * 8 + 4096)
+
+
+def test_appendable_dataset_writer(tmp_path):
+    with h5py.File(tmp_path / "test.h5", "w") as h5:
+        test_module.create_appendable_dataset(h5, "buffered", np.int64)
+        with test_module.AppendableDatasetWriter(h5["buffered"], buffer_bytes=32) as writer:
+            writer.append(np.arange(3))
+            assert len(h5["buffered"]) == 0
+            assert writer.buffered_bytes == 24
+            writer.append([])
+            writer.append(np.arange(3, 5))
+            assert len(h5["buffered"]) == 5
+            assert writer.buffered_bytes == 0
+            writer.append([5])
+        assert_array_equal(h5["buffered"], np.arange(6))
+
+        test_module.create_appendable_dataset(h5, "preallocated", np.float32, expected_size=10)
+        assert h5["preallocated"].chunks == (10,)
+        writer = test_module.AppendableDatasetWriter(h5["preallocated"], expected_size=10)
+        assert len(h5["preallocated"]) == 10
+        writer.append(np.arange(4))
+        writer.flush()
+        writer.append(np.arange(4, 8))
+        writer.close()
+        assert_array_equal(h5["preallocated"], np.arange(8))